@@ -18,27 +18,102 @@
 """Certify a GKI boot image by generating and appending its boot_signature."""
 
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
 import glob
+import itertools
 import os
 import shlex
 import shutil
+import struct
 import subprocess
 import tempfile
 
 from gki.generate_gki_certificate import generate_gki_certificate
-from unpack_bootimg import unpack_bootimg
 
+BOOT_MAGIC = b'ANDROID!'
+BOOT_MAGIC_SIZE = 8
+BOOT_IMAGE_HEADER_V3_PAGESIZE = 4096
 BOOT_SIGNATURE_SIZE = 16 * 1024
 
+# Resolves avbtool once. With a path to the executable and close_fds=False,
+# subprocess can spawn avbtool with posix_spawn() instead of fork() + exec().
+# Leaving close_fds off is safe, as Python opens files non-inheritable.
+AVBTOOL = shutil.which('avbtool') or 'avbtool'
+
+# _IOW(0x94, 9, int) from <linux/fs.h>.
+FICLONE = 0x40049409
+
+# Keep in sync with |AvbVBMetaImageHeader|.
+AVB_MAGIC = b'AVB0'
+AVB_VBMETA_IMAGE_HEADER_SIZE = 256
+AVB_VBMETA_IMAGE_HEADER_FORMAT = (
+    '!4s2L'      # magic, 2 x version.
+    '2Q'         # 2 x block size: Authentication and Auxiliary blocks.
+)
+
+# Keep in sync with |AvbFooter|.
+AVB_FOOTER_MAGIC = b'AVBf'
+AVB_FOOTER_FORMAT = (
+    '!4s2L'      # magic, 2 x version.
+    '3Q'         # original image size, vbmeta offset, vbmeta size.
+    '28x'        # reserved.
+)
+AVB_FOOTER_SIZE = struct.calcsize(AVB_FOOTER_FORMAT)
+
 
 def get_kernel(boot_img):
     """Extracts the kernel from |boot_img| and returns it."""
-    with tempfile.TemporaryDirectory() as unpack_dir:
-        unpack_bootimg(boot_img, unpack_dir)
-        with open(os.path.join(unpack_dir, 'kernel'), 'rb') as kernel:
-            kernel_bytes = kernel.read()
-            assert len(kernel_bytes) > 0
-            return kernel_bytes
+    with open(boot_img, 'rb') as image:
+        assert image.read(BOOT_MAGIC_SIZE) == BOOT_MAGIC
+        # In all header versions, kernel_size is the first field after the
+        # magic and header_version is the ninth one. page_size is the eighth
+        # field of boot image header v0-v2, and is fixed since v3.
+        header_fields = struct.unpack('9I', image.read(9 * 4))
+        kernel_size = header_fields[0]
+        header_version = header_fields[8]
+        if header_version < 3:
+            page_size = header_fields[7]
+        else:
+            page_size = BOOT_IMAGE_HEADER_V3_PAGESIZE
+
+        # The kernel starts at the page right after the header.
+        image.seek(page_size)
+        kernel_bytes = image.read(kernel_size)
+        assert len(kernel_bytes) > 0
+        return kernel_bytes
+
+
+def clone_file(src, dst):
+    """Copies |src| to |dst|, sharing the data blocks when possible.
+
+    Tries a reflink (FICLONE) first, which is O(1) on filesystems supporting
+    copy-on-write, e.g., btrfs and XFS. Falls back to a regular copy.
+    """
+    try:
+        with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+            fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+        shutil.copystat(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def get_vbmeta_size(vbmeta_bytes):
+    """Returns the total size of a AvbVBMeta image, or zero if not a vbmeta."""
+    header_size = struct.calcsize(AVB_VBMETA_IMAGE_HEADER_FORMAT)
+    if len(vbmeta_bytes) < header_size:
+        return 0
+
+    (magic, _, _,
+     authentication_block_size,
+     auxiliary_data_block_size) = struct.unpack_from(
+         AVB_VBMETA_IMAGE_HEADER_FORMAT, vbmeta_bytes)
+
+    if magic == AVB_MAGIC:
+        return (AVB_VBMETA_IMAGE_HEADER_SIZE +
+                authentication_block_size +
+                auxiliary_data_block_size)
+    return 0
 
 
 def add_certificate(boot_img, algorithm, key, extra_args):
@@ -52,32 +127,40 @@ def add_certificate(boot_img, algorithm, key, extra_args):
 
     def generate_certificate(image, certificate_name):
         """Generates the certificate and returns the certificate content."""
-        with tempfile.NamedTemporaryFile() as output_certificate:
-            generate_gki_certificate(
-                image=image, avbtool='avbtool', name=certificate_name,
-                algorithm=algorithm, key=key, salt='d00df00d',
-                additional_avb_args=extra_args, output=output_certificate.name)
-            output_certificate.seek(os.SEEK_SET, 0)
-            return output_certificate.read()
-
-    boot_signature_bytes = b''
-    boot_signature_bytes += generate_certificate(boot_img, 'boot')
+        return generate_gki_certificate(
+            image=image, avbtool=AVBTOOL, name=certificate_name,
+            algorithm=algorithm, key=key, salt='d00df00d',
+            additional_avb_args=extra_args, output=None)
 
     with tempfile.NamedTemporaryFile() as kernel_img:
         kernel_img.write(get_kernel(boot_img))
         kernel_img.flush()
-        boot_signature_bytes += generate_certificate(kernel_img.name,
-                                                     'generic_kernel')
 
-    if len(boot_signature_bytes) > BOOT_SIGNATURE_SIZE:
-        raise ValueError(
-            f'boot_signature size must be <= {BOOT_SIGNATURE_SIZE}')
-    boot_signature_bytes += (
-        b'\0' * (BOOT_SIGNATURE_SIZE - len(boot_signature_bytes)))
-    assert len(boot_signature_bytes) == BOOT_SIGNATURE_SIZE
-
-    with open(boot_img, 'ab') as f:
-        f.write(boot_signature_bytes)
+        # The two certificates are independent of each other, and the time is
+        # mostly spent in avbtool, so generate them concurrently.
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            boot_certificate = executor.submit(
+                generate_certificate, boot_img, 'boot')
+            generic_kernel_certificate = executor.submit(
+                generate_certificate, kernel_img.name, 'generic_kernel')
+
+    # The boot signature is zero-padded up to BOOT_SIGNATURE_SIZE.
+    boot_signature_bytes = bytearray(BOOT_SIGNATURE_SIZE)
+    offset = 0
+    for certificate in (boot_certificate.result(),
+                        generic_kernel_certificate.result()):
+        if offset + len(certificate) > BOOT_SIGNATURE_SIZE:
+            raise ValueError(
+                f'boot_signature size must be <= {BOOT_SIGNATURE_SIZE}')
+        boot_signature_bytes[offset:offset + len(certificate)] = certificate
+        offset += len(certificate)
+
+    fd = os.open(boot_img, os.O_WRONLY | os.O_APPEND)
+    try:
+        written = os.write(fd, boot_signature_bytes)
+        assert written == BOOT_SIGNATURE_SIZE
+    finally:
+        os.close(fd)
 
 
 def erase_certificate_and_avb_footer(boot_img):
@@ -86,48 +169,58 @@ def erase_certificate_and_avb_footer(boot_img):
     A boot image might already contain a certificate and/or a AVB footer.
     This function erases these additional metadata from the |boot_img|.
     """
-    # Tries to erase the AVB footer first, which may or may not exist.
-    avbtool_cmd = ['avbtool', 'erase_footer', '--image', boot_img]
-    subprocess.run(avbtool_cmd, check=False, stderr=subprocess.DEVNULL)
-    assert os.path.getsize(boot_img) > 0
-
-    # No boot signature to erase, just return.
-    if os.path.getsize(boot_img) <= BOOT_SIGNATURE_SIZE:
-        return
-
-    # Checks if the last 16K is a boot signature, then erases it.
-    with open(boot_img, 'rb') as image:
-        image.seek(-BOOT_SIGNATURE_SIZE, os.SEEK_END)
-        boot_signature = image.read(BOOT_SIGNATURE_SIZE)
-        assert len(boot_signature) == BOOT_SIGNATURE_SIZE
-
-    with tempfile.NamedTemporaryFile() as signature_tmpfile:
-        signature_tmpfile.write(boot_signature)
-        signature_tmpfile.flush()
-        avbtool_info_cmd = [
-            'avbtool', 'info_image', '--image', signature_tmpfile.name]
-        result = subprocess.run(avbtool_info_cmd, check=False,
-                                stdout=subprocess.DEVNULL,
-                                stderr=subprocess.DEVNULL)
-        has_boot_signature = (result.returncode == 0)
+    with open(boot_img, 'r+b') as image:
+        # Tries to erase the AVB footer first, which may or may not exist.
+        # Same as 'avbtool erase_footer', which drops everything after the
+        # original image size recorded in the footer.
+        footer = get_avb_footer(image)
+        if footer:
+            (_, _, _, image_size, _, _) = footer
+        else:
+            image_size = image.seek(0, os.SEEK_END)
+        assert image_size > 0
+
+        # Checks if the last 16K is a boot signature, then erases it.
+        if image_size > BOOT_SIGNATURE_SIZE:
+            image.seek(image_size - BOOT_SIGNATURE_SIZE)
+            boot_signature = image.read(BOOT_SIGNATURE_SIZE)
+            assert len(boot_signature) == BOOT_SIGNATURE_SIZE
+
+            # A boot signature starts with a vbmeta image, which must fit in
+            # the reserved space.
+            vbmeta_size = get_vbmeta_size(boot_signature)
+            if 0 < vbmeta_size <= BOOT_SIGNATURE_SIZE:
+                image_size -= BOOT_SIGNATURE_SIZE
+
+        # Erases the AVB footer and the boot signature with one truncation.
+        image.truncate(image_size)
+
+    assert image_size > 0
+
+
+def get_avb_footer(image_file):
+    """Returns the fields of the AVB footer of |image_file|, or None if absent.
 
-    if has_boot_signature:
-        new_file_size = os.path.getsize(boot_img) - BOOT_SIGNATURE_SIZE
-        os.truncate(boot_img, new_file_size)
+    Args:
+        image_file: a binary file object of the image, it will be seeked.
+    """
+    if image_file.seek(0, os.SEEK_END) < AVB_FOOTER_SIZE:
+        return None
+    image_file.seek(-AVB_FOOTER_SIZE, os.SEEK_END)
+    footer = struct.unpack(AVB_FOOTER_FORMAT,
+                           image_file.read(AVB_FOOTER_SIZE))
 
-    assert os.path.getsize(boot_img) > 0
+    if footer[0] != AVB_FOOTER_MAGIC:
+        return None
+    return footer
 
 
 def get_avb_image_size(image):
     """Returns the image size if there is a AVB footer, else return zero."""
 
-    avbtool_info_cmd = ['avbtool', 'info_image', '--image', image]
-    result = subprocess.run(avbtool_info_cmd, check=False,
-                            stdout=subprocess.DEVNULL,
-                            stderr=subprocess.DEVNULL)
-
-    if result.returncode == 0:
-        return os.path.getsize(image)
+    with open(image, 'rb') as f:
+        if get_avb_footer(f):
+            return f.seek(0, os.SEEK_END)
 
     return 0
 
@@ -135,7 +228,7 @@ def get_avb_image_size(image):
 def add_avb_footer(image, partition_size, extra_footer_args):
     """Appends a AVB hash footer to the image."""
 
-    avbtool_cmd = ['avbtool', 'add_hash_footer', '--image', image,
+    avbtool_cmd = [AVBTOOL, 'add_hash_footer', '--image', image,
                    '--partition_name', 'boot']
 
     if partition_size:
@@ -144,7 +237,7 @@ def add_avb_footer(image, partition_size, extra_footer_args):
         avbtool_cmd.extend(['--dynamic_partition_size'])
 
     avbtool_cmd.extend(extra_footer_args)
-    subprocess.check_call(avbtool_cmd)
+    subprocess.check_call(avbtool_cmd, close_fds=False)
 
 
 def load_dict_from_file(path):
@@ -228,15 +321,10 @@ def parse_cmdline():
         parser.error('--gki_info cannot be used with --boot_image_archive. '
                      'The gki_info file should be included in the archive.')
 
-    extra_args = []
-    for a in args.extra_args:
-        extra_args.extend(shlex.split(a))
-    args.extra_args = extra_args
-
-    extra_footer_args = []
-    for a in args.extra_footer_args:
-        extra_footer_args.extend(shlex.split(a))
-    args.extra_footer_args = extra_footer_args
+    args.extra_args = list(itertools.chain.from_iterable(
+        shlex.split(a) for a in args.extra_args))
+    args.extra_footer_args = list(itertools.chain.from_iterable(
+        shlex.split(a) for a in args.extra_footer_args))
 
     if args.gki_info:
         load_gki_info_file(args.gki_info,
@@ -249,9 +337,23 @@ def parse_cmdline():
 def certify_bootimg(boot_img, output_img, algorithm, key, extra_args,
                     extra_footer_args):
     """Certify a GKI boot image by generating and appending a boot_signature."""
-    with tempfile.TemporaryDirectory() as temp_dir:
+    # Works on a temp image next to |output_img|, so the input image can be
+    # cloned and the result can be renamed into place, without copying the
+    # whole image when the filesystem supports it.
+    output_dir = os.path.dirname(os.path.abspath(output_img))
+    try:
+        temp_dir_manager = tempfile.TemporaryDirectory(dir=output_dir)
+        # Renaming would replace a symlinked |output_img| rather than write
+        # through it.
+        rename_output = not os.path.islink(output_img)
+    except OSError:
+        # The output directory isn't writable, only |output_img| might be.
+        temp_dir_manager = tempfile.TemporaryDirectory()
+        rename_output = False
+
+    with temp_dir_manager as temp_dir:
         boot_tmp = os.path.join(temp_dir, 'boot.tmp')
-        shutil.copy2(boot_img, boot_tmp)
+        clone_file(boot_img, boot_tmp)
 
         erase_certificate_and_avb_footer(boot_tmp)
         add_certificate(boot_tmp, algorithm, key, extra_args)
@@ -259,8 +361,11 @@ def certify_bootimg(boot_img, output_img, algorithm, key, extra_args,
         avb_partition_size = get_avb_image_size(boot_img)
         add_avb_footer(boot_tmp, avb_partition_size, extra_footer_args)
 
-        # We're done, copy the temp image to the final output.
-        shutil.copy2(boot_tmp, output_img)
+        # We're done, move the temp image to the final output.
+        if rename_output:
+            os.replace(boot_tmp, output_img)
+        else:
+            shutil.copy2(boot_tmp, output_img)
 
 
 def certify_bootimg_archive(boot_img_archive, output_archive,
@@ -29,6 +29,8 @@ import unittest
 
 BOOT_SIGNATURE_SIZE = 16 * 1024
 
+TEST_FILE_CHUNK_SIZE = 64 * 1024
+
 TEST_KERNEL_CMDLINE = (
     'printk.devkmsg=on firmware_class.path=/vendor/etc/ init=/init '
     'kfence.sample_interval=500 loop.max_part=7 bootconfig'
@@ -39,7 +41,11 @@ def generate_test_file(pathname, size, seed=None):
     """Generates a gibberish-filled test file and returns its pathname."""
     random.seed(os.path.basename(pathname) if seed is None else seed)
     with open(pathname, 'wb') as file:
-        file.write(random.randbytes(size))
+        # Writes in chunks to bound the memory usage. The chunk size must be a
+        # multiple of 4, so the file content is the same as randbytes(size).
+        for offset in range(0, size, TEST_FILE_CHUNK_SIZE):
+            file.write(random.randbytes(
+                min(TEST_FILE_CHUNK_SIZE, size - offset)))
     return pathname
 
 
@@ -108,15 +114,20 @@ def generate_test_boot_image_archive(archive_file_name, archive_format,
                                    temp_out_dir)
 
 
+def run_silently(cmd):
+    """Runs |cmd| with its output discarded and returns its exit status."""
+    # The fds opened by Python are non-inheritable, so they needn't be
+    # closed in the child process.
+    return subprocess.run(cmd, check=False, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL,
+                          close_fds=False).returncode
+
+
 def has_avb_footer(image):
     """Returns true if the image has a avb footer."""
 
     avbtool_info_cmd = ['avbtool', 'info_image', '--image', image]
-    result = subprocess.run(avbtool_info_cmd, check=False,
-                            stdout=subprocess.DEVNULL,
-                            stderr=subprocess.DEVNULL)
-
-    return result.returncode == 0
+    return run_silently(avbtool_info_cmd) == 0
 
 
 def get_vbmeta_size(vbmeta_bytes):
@@ -133,10 +144,10 @@ def get_vbmeta_size(vbmeta_bytes):
     if len(vbmeta_bytes) < struct.calcsize(FORMAT_STRING):
         return 0
 
-    data = vbmeta_bytes[:struct.calcsize(FORMAT_STRING)]
     (magic, _, _,
      authentication_block_size,
-     auxiliary_data_block_size) = struct.unpack(FORMAT_STRING, data)
+     auxiliary_data_block_size) = struct.unpack_from(FORMAT_STRING,
+                                                     vbmeta_bytes)
 
     if magic == AVB_MAGIC:
         return (AVB_VBMETA_IMAGE_HEADER_SIZE +
@@ -156,7 +167,7 @@ def extract_boot_signatures(boot_img, output_dir):
     boot_img_copy = os.path.join(output_dir, 'boot_image_copy')
     shutil.copy2(boot_img, boot_img_copy)
     avbtool_cmd = ['avbtool', 'erase_footer', '--image', boot_img_copy]
-    subprocess.run(avbtool_cmd, check=False, stderr=subprocess.DEVNULL)
+    run_silently(avbtool_cmd)
 
     # The boot signature is assumed to be at the end of boot image, after
     # the AVB footer is erased.
@@ -166,21 +177,26 @@ def extract_boot_signatures(boot_img, output_dir):
         assert len(boot_signature_bytes) == BOOT_SIGNATURE_SIZE
     os.unlink(boot_img_copy)
 
+    # Walks through the signatures with an offset into a memoryview, instead
+    # of slicing (copying) the remaining bytes for each signature.
+    boot_signature_view = memoryview(boot_signature_bytes)
+    offset = 0
     num_signatures = 0
     while True:
-        next_signature_size = get_vbmeta_size(boot_signature_bytes)
+        next_signature_size = get_vbmeta_size(boot_signature_view[offset:])
         if next_signature_size <= 0:
             break
 
         num_signatures += 1
-        next_signature = boot_signature_bytes[:next_signature_size]
+        next_signature = boot_signature_view[
+            offset:offset + next_signature_size]
         output_path = os.path.join(
             output_dir, 'boot_signature' + str(num_signatures))
         with open(output_path, 'wb') as output:
             output.write(next_signature)
 
         # Moves to the next signature.
-        boot_signature_bytes = boot_signature_bytes[next_signature_size:]
+        offset += next_signature_size
 
 
 def extract_boot_archive_with_signatures(boot_img_archive, output_dir):
@@ -207,6 +223,37 @@ def extract_boot_archive_with_signatures(boot_img_archive, output_dir):
 class CertifyBootimgTest(unittest.TestCase):
     """Tests the functionalities of certify_bootimg."""
 
+    @classmethod
+    def setUpClass(cls):
+        # Generates the test boot images once for all tests. Each test works
+        # on its own copy, see _copy_test_boot_image().
+        cls._test_boot_images_dir = tempfile.TemporaryDirectory()
+        generate_test_boot_image(
+            os.path.join(cls._test_boot_images_dir.name, 'boot.img'))
+        generate_test_boot_image(
+            os.path.join(cls._test_boot_images_dir.name, 'boot-avb.img'),
+            avb_partition_size=128 * 1024)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._test_boot_images_dir.cleanup()
+
+    def _copy_test_boot_image(self, name, output_dir):
+        """Copies the test boot image |name| to |output_dir|/boot.img.
+
+        Args:
+            name: 'boot.img' for a boot image without an AVB footer, or
+                'boot-avb.img' for one with an AVB footer.
+            output_dir: the directory to copy the boot image to.
+
+        Returns:
+            The pathname of the copied boot image.
+        """
+        boot_img = os.path.join(output_dir, 'boot.img')
+        shutil.copy2(os.path.join(self._test_boot_images_dir.name, name),
+                     boot_img)
+        return boot_img
+
     def setUp(self):
         # Saves the test executable directory so that relative path references
         # to test dependencies don't rely on being manually run from the
@@ -777,8 +824,7 @@ class CertifyBootimgTest(unittest.TestCase):
     def test_certify_bootimg_without_avb_footer(self):
         """Tests certify_bootimg on a boot image without an AVB footer."""
         with tempfile.TemporaryDirectory() as temp_out_dir:
-            boot_img = os.path.join(temp_out_dir, 'boot.img')
-            generate_test_boot_image(boot_img)
+            boot_img = self._copy_test_boot_image('boot.img', temp_out_dir)
 
             # Generates the certified boot image, with a RSA2048 key.
             boot_certified_img = os.path.join(temp_out_dir,
@@ -794,13 +840,9 @@ class CertifyBootimgTest(unittest.TestCase):
             ]
             subprocess.run(certify_bootimg_cmds, check=True, cwd=self._exec_dir)
 
-            extract_boot_signatures(boot_certified_img, temp_out_dir)
-            self._test_boot_signatures(
-                temp_out_dir,
-                {'boot_signature1': self._EXPECTED_BOOT_SIGNATURE_RSA2048,
-                 'boot_signature2': self._EXPECTED_KERNEL_SIGNATURE_RSA2048})
-
             # Generates the certified boot image again, with a RSA4096 key.
+            # It only reads the first certified boot image, so it can run
+            # while the first one is being checked.
             boot_certified2_img = os.path.join(temp_out_dir,
                                               'boot-certified2.img')
             certify_bootimg_cmds = [
@@ -812,7 +854,15 @@ class CertifyBootimgTest(unittest.TestCase):
                 '--prop space:"nice to meet you"',
                 '--output', boot_certified2_img,
             ]
-            subprocess.run(certify_bootimg_cmds, check=True, cwd=self._exec_dir)
+            with subprocess.Popen(certify_bootimg_cmds,
+                                  cwd=self._exec_dir) as certify_bootimg2:
+                extract_boot_signatures(boot_certified_img, temp_out_dir)
+                self._test_boot_signatures(
+                    temp_out_dir,
+                    {'boot_signature1': self._EXPECTED_BOOT_SIGNATURE_RSA2048,
+                     'boot_signature2':
+                        self._EXPECTED_KERNEL_SIGNATURE_RSA2048})
+            self.assertEqual(certify_bootimg2.returncode, 0)
 
             extract_boot_signatures(boot_certified2_img, temp_out_dir)
             self._test_boot_signatures(
@@ -823,9 +873,8 @@ class CertifyBootimgTest(unittest.TestCase):
     def test_certify_bootimg_with_avb_footer(self):
         """Tests the AVB footer location remains after certify_bootimg."""
         with tempfile.TemporaryDirectory() as temp_out_dir:
-            boot_img = os.path.join(temp_out_dir, 'boot.img')
-            generate_test_boot_image(boot_img=boot_img,
-                                     avb_partition_size=128 * 1024)
+            boot_img = self._copy_test_boot_image('boot-avb.img',
+                                                  temp_out_dir)
             self.assertTrue(has_avb_footer(boot_img))
 
             # Generates the certified boot image, with a RSA2048 key.
@@ -897,9 +946,8 @@ class CertifyBootimgTest(unittest.TestCase):
     def test_certify_bootimg_with_gki_info(self):
         """Tests certify_bootimg with --gki_info."""
         with tempfile.TemporaryDirectory() as temp_out_dir:
-            boot_img = os.path.join(temp_out_dir, 'boot.img')
-            generate_test_boot_image(boot_img=boot_img,
-                                     avb_partition_size=128 * 1024)
+            boot_img = self._copy_test_boot_image('boot-avb.img',
+                                                  temp_out_dir)
             self.assertTrue(has_avb_footer(boot_img))
 
             gki_info = ('certify_bootimg_extra_args='
@@ -955,8 +1003,7 @@ class CertifyBootimgTest(unittest.TestCase):
     def test_certify_bootimg_exceed_size(self):
         """Tests the boot signature size exceeded max size of the signature."""
         with tempfile.TemporaryDirectory() as temp_out_dir:
-            boot_img = os.path.join(temp_out_dir, 'boot.img')
-            generate_test_boot_image(boot_img)
+            boot_img = self._copy_test_boot_image('boot.img', temp_out_dir)
 
             # Certifies the boot.img with many --extra_args, and checks
             # it will raise the ValueError() exception.
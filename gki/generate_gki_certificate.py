@@ -18,13 +18,24 @@
 """Generate a Generic Boot Image certificate suitable for VTS verification."""
 
 from argparse import ArgumentParser
+import os
 import shlex
 import subprocess
 
 
 def generate_gki_certificate(image, avbtool, name, algorithm, key, salt,
                              additional_avb_args, output):
-    """Shell out to avbtool to generate a GKI certificate."""
+    """Shell out to avbtool to generate a GKI certificate.
+
+    The certificate is written to the |output| file. If |output| is None,
+    avbtool writes the certificate to a pipe, and it is returned instead.
+    avbtool's own stdout is left alone, so nothing else it prints can end up
+    in the certificate.
+    """
+    write_fd = None
+    if output is None:
+        read_fd, write_fd = os.pipe()
+        output = f'/dev/fd/{write_fd}'
 
     # Need to specify a value of --partition_size for avbtool to work.
     # We use 64 MB below, but avbtool will not resize the boot image to
@@ -45,7 +56,21 @@ def generate_gki_certificate(image, avbtool, name, algorithm, key, salt,
 
     avbtool_cmd += additional_avb_args
 
-    subprocess.check_call(avbtool_cmd)
+    if write_fd is None:
+        subprocess.check_call(avbtool_cmd, close_fds=False)
+        return None
+
+    with os.fdopen(read_fd, 'rb') as certificate:
+        try:
+            proc = subprocess.Popen(avbtool_cmd, pass_fds=(write_fd,))
+        finally:
+            # Only avbtool keeps the write end open, so the read below ends
+            # when avbtool exits.
+            os.close(write_fd)
+        certificate_bytes = certificate.read()
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, avbtool_cmd)
+    return certificate_bytes
 
 
 def parse_cmdline():
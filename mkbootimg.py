@@ -16,14 +16,14 @@
 
 """Creates the boot image."""
 
-from argparse import (ArgumentParser, ArgumentTypeError,
+from argparse import (Action, ArgumentParser, ArgumentTypeError,
                       FileType, RawDescriptionHelpFormatter)
-from hashlib import sha1
+from hashlib import blake2b, sha1
 from os import fstat
-from struct import pack
+from struct import pack, Struct
 
-import array
 import collections
+import mmap
 import os
 import re
 import tempfile
@@ -59,37 +59,219 @@ VENDOR_RAMDISK_NAME_SIZE = 32
 VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE = 16
 VENDOR_RAMDISK_TABLE_ENTRY_V4_SIZE = 108
 
+BOOT_IMAGE_HEADER_V0_FORMAT = (
+    f'<{BOOT_MAGIC_SIZE}s'
+    'I'     # kernel size in bytes
+    'I'     # kernel physical load address
+    'I'     # ramdisk size in bytes
+    'I'     # ramdisk physical load address
+    'I'     # second bootloader size in bytes
+    'I'     # second bootloader physical load address
+    'I'     # kernel tags physical load address
+    'I'     # flash page size
+    'I'     # version of boot image header or dt size in bytes
+    'I'     # os version and patch level
+    f'{BOOT_NAME_SIZE}s'        # asciiz product name
+    f'{BOOT_ARGS_SIZE}s'        # kernel command line
+    '32s'   # image id
+    f'{BOOT_EXTRA_ARGS_SIZE}s'  # extra kernel command line
+)
+BOOT_IMAGE_HEADER_V1_FORMAT = (
+    BOOT_IMAGE_HEADER_V0_FORMAT +
+    'I'     # recovery dtbo size in bytes
+    'Q'     # recovery dtbo offset in the boot image
+    'I'     # boot image header size in bytes
+)
+BOOT_IMAGE_HEADER_V2_FORMAT = (
+    BOOT_IMAGE_HEADER_V1_FORMAT +
+    'I'     # dtb size in bytes
+    'Q'     # dtb physical load address
+)
+BOOT_IMAGE_HEADER_V3_FORMAT = (
+    f'<{BOOT_MAGIC_SIZE}s'
+    'I'     # kernel size in bytes
+    'I'     # ramdisk size in bytes
+    'I'     # os version and patch level
+    'I'     # boot image header size in bytes
+    '4I'    # reserved
+    'I'     # version of boot image header
+    f'{BOOT_ARGS_SIZE + BOOT_EXTRA_ARGS_SIZE}s'  # kernel command line
+)
+BOOT_IMAGE_HEADER_V4_FORMAT = (
+    BOOT_IMAGE_HEADER_V3_FORMAT +
+    'I'     # boot signature size in bytes
+)
+
+# Boot image header structs, indexed by the header version.
+BOOT_IMAGE_HEADER_STRUCTS = [
+    Struct(BOOT_IMAGE_HEADER_V0_FORMAT),
+    Struct(BOOT_IMAGE_HEADER_V1_FORMAT),
+    Struct(BOOT_IMAGE_HEADER_V2_FORMAT),
+    Struct(BOOT_IMAGE_HEADER_V3_FORMAT),
+    Struct(BOOT_IMAGE_HEADER_V4_FORMAT),
+]
+
+VENDOR_BOOT_IMAGE_HEADER_V3_FORMAT = (
+    f'<{VENDOR_BOOT_MAGIC_SIZE}s'
+    'I'     # version of boot image header
+    'I'     # flash page size
+    'I'     # kernel physical load address
+    'I'     # ramdisk physical load address
+    'I'     # ramdisk size in bytes
+    f'{VENDOR_BOOT_ARGS_SIZE}s'     # vendor kernel command line
+    'I'     # kernel tags physical load address
+    f'{VENDOR_BOOT_NAME_SIZE}s'     # asciiz product name
+    'I'     # vendor boot image header size in bytes
+    'I'     # dtb size in bytes
+    'Q'     # dtb physical load address
+)
+VENDOR_BOOT_IMAGE_HEADER_V4_FORMAT = (
+    VENDOR_BOOT_IMAGE_HEADER_V3_FORMAT +
+    'I'     # vendor ramdisk table size in bytes
+    'I'     # number of vendor ramdisk table entries
+    'I'     # vendor ramdisk table entry size in bytes
+    'I'     # bootconfig section size in bytes
+)
+VENDOR_BOOT_IMAGE_HEADER_V3_STRUCT = Struct(VENDOR_BOOT_IMAGE_HEADER_V3_FORMAT)
+VENDOR_BOOT_IMAGE_HEADER_V4_STRUCT = Struct(VENDOR_BOOT_IMAGE_HEADER_V4_FORMAT)
+
+VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_STRUCT = Struct(
+    f'<{VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE}I')
+# The packed board_id of entries that don't specify one.
+ZERO_BOARD_ID = bytes(VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_STRUCT.size)
+VENDOR_RAMDISK_TABLE_ENTRY_V4_STRUCT = Struct(
+    '<'
+    'I'     # ramdisk size in bytes
+    'I'     # ramdisk offset in the vendor ramdisk section
+    'I'     # ramdisk type
+    f'{VENDOR_RAMDISK_NAME_SIZE}s'  # asciiz ramdisk name
+    f'{VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_STRUCT.size}s'  # board id
+)
+
 # Names with special meaning, mustn't be specified in --ramdisk_name.
 VENDOR_RAMDISK_NAME_BLOCKLIST = {b'default'}
 
 PARSER_ARGUMENT_VENDOR_RAMDISK_FRAGMENT = '--vendor_ramdisk_fragment'
 
+OS_VERSION_RE = re.compile(r'(\d{1,3})(?:\.(\d{1,3})(?:\.(\d{1,3}))?)?')
+OS_PATCH_LEVEL_RE = re.compile(r'(\d{4})-(\d{2})(?:-(\d{2}))?')
+
+# Input files are streamed in chunks of this size, instead of being read
+# into memory as a whole. It's also the buffer size of the output images.
+IO_CHUNK_SIZE = 1024 * 1024
+
+# Zeros for padding the sections, up to the largest supported page size.
+ZERO_PAGE = bytes(2**14)
+
 
 def filesize(f):
+    """Returns the size of the input file |f|, or zero if it's None.
+
+    The size is cached on the file object, as the input files don't change
+    while building the image.
+    """
     if f is None:
         return 0
+    size = getattr(f, '_mkbootimg_size', None)
+    if size is None:
+        try:
+            size = fstat(f.fileno()).st_size
+        except OSError:
+            size = 0
+        f._mkbootimg_size = size  # pylint: disable=protected-access
+    return size
+
+
+def read_chunks(f):
+    """Yields the remaining content of |f| in chunks.
+
+    The chunks are memoryviews of a single reused buffer, so each one must be
+    consumed before the next one is requested.
+    """
+    buf = bytearray(IO_CHUNK_SIZE)
+    view = memoryview(buf)
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            break
+        yield view[:n]
+
+
+def write_file(f_out, f_in):
+    """Copies the remaining content of |f_in| to |f_out|."""
+    offset = f_in.tell()
     try:
-        return fstat(f.fileno()).st_size
-    except OSError:
-        return 0
+        # Lets the kernel copy the data with sendfile(), so it doesn't go
+        # through user space. This requires flushing |f_out| first.
+        f_out.flush()
+        size = filesize(f_in)
+        while offset < size:
+            sent = os.sendfile(f_out.fileno(), f_in.fileno(), offset,
+                               size - offset)
+            if sent == 0:
+                break
+            offset += sent
+        f_in.seek(offset)
+    except (AttributeError, OSError):
+        # sendfile() is unavailable or unsupported for these files.
+        f_in.seek(offset)
+        for chunk in read_chunks(f_in):
+            f_out.write(chunk)
+
+
+def prefetch_files(files):
+    """Starts reading |files| into the page cache in the background.
+
+    The reads of all the files then overlap, instead of each one only
+    starting when the previous file has been consumed.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for f in files:
+        if f is None:
+            continue
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
 
 
 def update_sha(sha, f):
     if f:
-        sha.update(f.read())
-        f.seek(0)
-        sha.update(pack('I', filesize(f)))
+        size = 0
+        try:
+            # Hashes the page cache directly, without copying the file into
+            # a buffer first.
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    m.madvise(mmap.MADV_SEQUENTIAL)
+                sha.update(m)
+                size = len(m)
+        except (OSError, ValueError):
+            # Empty files and pipes can't be mapped.
+            for chunk in read_chunks(f):
+                sha.update(chunk)
+                size += len(chunk)
+            f.seek(0)
+        sha.update(pack('<I', size))
     else:
-        sha.update(pack('I', 0))
+        sha.update(pack('<I', 0))
 
 
 def pad_file(f, padding):
-    pad = (padding - (f.tell() & (padding - 1))) & (padding - 1)
-    f.write(pack(str(pad) + 'x'))
+    pad = -f.tell() & (padding - 1)
+    if pad:
+        f.write(ZERO_PAGE[:pad])
 
 
 def get_number_of_pages(image_size, page_size):
-    """calculates the number of pages required for the image"""
+    """calculates the number of pages required for the image
+
+    >>> get_number_of_pages(0, 4096)
+    0
+    >>> get_number_of_pages(4097, 4096)
+    2
+    """
     return (image_size + page_size - 1) // page_size
 
 
@@ -117,76 +299,69 @@ def write_header_v3_and_above(args):
     else:
         boot_header_size = BOOT_IMAGE_HEADER_V3_SIZE
 
-    args.output.write(pack(f'{BOOT_MAGIC_SIZE}s', BOOT_MAGIC.encode()))
-    # kernel size in bytes
-    args.output.write(pack('I', filesize(args.kernel)))
-    # ramdisk size in bytes
-    args.output.write(pack('I', filesize(args.ramdisk)))
-    # os version and patch level
-    args.output.write(pack('I', (args.os_version << 11) | args.os_patch_level))
-    args.output.write(pack('I', boot_header_size))
-    # reserved
-    args.output.write(pack('4I', 0, 0, 0, 0))
-    # version of boot image header
-    args.output.write(pack('I', args.header_version))
-    args.output.write(pack(f'{BOOT_ARGS_SIZE + BOOT_EXTRA_ARGS_SIZE}s',
-                           args.cmdline))
+    header_fields = [
+        BOOT_MAGIC.encode(),
+        filesize(args.kernel),
+        filesize(args.ramdisk),
+        (args.os_version << 11) | args.os_patch_level,
+        boot_header_size,
+        0, 0, 0, 0,
+        args.header_version,
+        args.cmdline,
+    ]
     if args.header_version >= 4:
         # The signature used to verify boot image v4.
         boot_signature_size = 0
         if should_add_legacy_gki_boot_signature(args):
             boot_signature_size = BOOT_IMAGE_V4_SIGNATURE_SIZE
-        args.output.write(pack('I', boot_signature_size))
-    pad_file(args.output, BOOT_IMAGE_HEADER_V3_PAGESIZE)
+        header_fields.append(boot_signature_size)
+
+    # The header is packed into a zero-filled page, so the padding comes free.
+    header = bytearray(BOOT_IMAGE_HEADER_V3_PAGESIZE)
+    BOOT_IMAGE_HEADER_STRUCTS[args.header_version].pack_into(
+        header, 0, *header_fields)
+    args.output.write(header)
 
 
 def write_vendor_boot_header(args):
     if args.header_version > 3:
         vendor_ramdisk_size = args.vendor_ramdisk_total_size
         vendor_boot_header_size = VENDOR_BOOT_IMAGE_HEADER_V4_SIZE
+        header_struct = VENDOR_BOOT_IMAGE_HEADER_V4_STRUCT
     else:
         vendor_ramdisk_size = filesize(args.vendor_ramdisk)
         vendor_boot_header_size = VENDOR_BOOT_IMAGE_HEADER_V3_SIZE
-
-    args.vendor_boot.write(pack(f'{VENDOR_BOOT_MAGIC_SIZE}s',
-                                VENDOR_BOOT_MAGIC.encode()))
-    # version of boot image header
-    args.vendor_boot.write(pack('I', args.header_version))
-    # flash page size
-    args.vendor_boot.write(pack('I', args.pagesize))
-    # kernel physical load address
-    args.vendor_boot.write(pack('I', args.base + args.kernel_offset))
-    # ramdisk physical load address
-    args.vendor_boot.write(pack('I', args.base + args.ramdisk_offset))
-    # ramdisk size in bytes
-    args.vendor_boot.write(pack('I', vendor_ramdisk_size))
-    args.vendor_boot.write(pack(f'{VENDOR_BOOT_ARGS_SIZE}s',
-                                args.vendor_cmdline))
-    # kernel tags physical load address
-    args.vendor_boot.write(pack('I', args.base + args.tags_offset))
-    # asciiz product name
-    args.vendor_boot.write(pack(f'{VENDOR_BOOT_NAME_SIZE}s', args.board))
-
-    # header size in bytes
-    args.vendor_boot.write(pack('I', vendor_boot_header_size))
-
-    # dtb size in bytes
-    args.vendor_boot.write(pack('I', filesize(args.dtb)))
-    # dtb physical load address
-    args.vendor_boot.write(pack('Q', args.base + args.dtb_offset))
-
+        header_struct = VENDOR_BOOT_IMAGE_HEADER_V3_STRUCT
+
+    header_fields = [
+        VENDOR_BOOT_MAGIC.encode(),
+        args.header_version,
+        args.pagesize,
+        args.base + args.kernel_offset,
+        args.base + args.ramdisk_offset,
+        vendor_ramdisk_size,
+        args.vendor_cmdline,
+        args.base + args.tags_offset,
+        args.board,
+        vendor_boot_header_size,
+        filesize(args.dtb),
+        args.base + args.dtb_offset,
+    ]
     if args.header_version > 3:
         vendor_ramdisk_table_size = (args.vendor_ramdisk_table_entry_num *
                                      VENDOR_RAMDISK_TABLE_ENTRY_V4_SIZE)
-        # vendor ramdisk table size in bytes
-        args.vendor_boot.write(pack('I', vendor_ramdisk_table_size))
-        # number of vendor ramdisk table entries
-        args.vendor_boot.write(pack('I', args.vendor_ramdisk_table_entry_num))
-        # vendor ramdisk table entry size in bytes
-        args.vendor_boot.write(pack('I', VENDOR_RAMDISK_TABLE_ENTRY_V4_SIZE))
-        # bootconfig section size in bytes
-        args.vendor_boot.write(pack('I', filesize(args.vendor_bootconfig)))
-    pad_file(args.vendor_boot, args.pagesize)
+        header_fields.extend([
+            vendor_ramdisk_table_size,
+            args.vendor_ramdisk_table_entry_num,
+            VENDOR_RAMDISK_TABLE_ENTRY_V4_SIZE,
+            filesize(args.vendor_bootconfig),
+        ])
+
+    # The vendor boot header is larger than a page when pagesize is 2048.
+    header = bytearray(args.pagesize *
+                       get_number_of_pages(header_struct.size, args.pagesize))
+    header_struct.pack_into(header, 0, *header_fields)
+    args.vendor_boot.write(header)
 
 
 def write_header(args):
@@ -201,74 +376,71 @@ def write_header(args):
     second_load_address = ((args.base + args.second_offset)
                            if filesize(args.second) > 0 else 0)
 
-    args.output.write(pack(f'{BOOT_MAGIC_SIZE}s', BOOT_MAGIC.encode()))
-    # kernel size in bytes
-    args.output.write(pack('I', filesize(args.kernel)))
-    # kernel physical load address
-    args.output.write(pack('I', args.base + args.kernel_offset))
-    # ramdisk size in bytes
-    args.output.write(pack('I', filesize(args.ramdisk)))
-    # ramdisk physical load address
-    args.output.write(pack('I', ramdisk_load_address))
-    # second bootloader size in bytes
-    args.output.write(pack('I', filesize(args.second)))
-    # second bootloader physical load address
-    args.output.write(pack('I', second_load_address))
-    # kernel tags physical load address
-    args.output.write(pack('I', args.base + args.tags_offset))
-    # flash page size
-    args.output.write(pack('I', args.pagesize))
-    # version of boot image header or dt size in bytes
-    args.output.write(pack('I', max(args.header_version, filesize(args.dt))))
-    # os version and patch level
-    args.output.write(pack('I', (args.os_version << 11) | args.os_patch_level))
-    # asciiz product name
-    args.output.write(pack(f'{BOOT_NAME_SIZE}s', args.board))
-    args.output.write(pack(f'{BOOT_ARGS_SIZE}s', args.cmdline))
-
-    sha = sha1()
-    update_sha(sha, args.kernel)
-    update_sha(sha, args.ramdisk)
-    update_sha(sha, args.second)
-    update_sha(sha, args.dt)
-
+    if args.image_id_hash == 'blake2b':
+        # Same digest size as SHA-1, as the image ID is a 32-byte field.
+        image_id_hasher = blake2b(digest_size=20)
+    else:
+        image_id_hasher = sha1(usedforsecurity=False)
+    hashed_files = [args.kernel, args.ramdisk, args.second, args.dt]
     if args.header_version > 0:
-        update_sha(sha, args.recovery_dtbo)
+        hashed_files.append(args.recovery_dtbo)
     if args.header_version > 1:
-        update_sha(sha, args.dtb)
-
-    img_id = pack('32s', sha.digest())
-
-    args.output.write(img_id)
-    args.output.write(pack(f'{BOOT_EXTRA_ARGS_SIZE}s', args.extra_cmdline))
+        hashed_files.append(args.dtb)
+
+    prefetch_files(hashed_files)
+    for f in hashed_files:
+        update_sha(image_id_hasher, f)
+
+    img_id = pack('<32s', image_id_hasher.digest())
+
+    header_fields = [
+        BOOT_MAGIC.encode(),
+        filesize(args.kernel),
+        args.base + args.kernel_offset,
+        filesize(args.ramdisk),
+        ramdisk_load_address,
+        filesize(args.second),
+        second_load_address,
+        args.base + args.tags_offset,
+        args.pagesize,
+        max(args.header_version, filesize(args.dt)),
+        (args.os_version << 11) | args.os_patch_level,
+        args.board,
+        args.cmdline,
+        img_id,
+        args.extra_cmdline,
+    ]
 
     if args.header_version > 0:
         if args.recovery_dtbo:
-            # recovery dtbo size in bytes
-            args.output.write(pack('I', filesize(args.recovery_dtbo)))
-            # recovert dtbo offset in the boot image
-            args.output.write(pack('Q', get_recovery_dtbo_offset(args)))
+            header_fields.extend([
+                filesize(args.recovery_dtbo),
+                get_recovery_dtbo_offset(args),
+            ])
         else:
             # Set to zero if no recovery dtbo
-            args.output.write(pack('I', 0))
-            args.output.write(pack('Q', 0))
+            header_fields.extend([0, 0])
 
     # Populate boot image header size for header versions 1 and 2.
     if args.header_version == 1:
-        args.output.write(pack('I', BOOT_IMAGE_HEADER_V1_SIZE))
+        header_fields.append(BOOT_IMAGE_HEADER_V1_SIZE)
     elif args.header_version == 2:
-        args.output.write(pack('I', BOOT_IMAGE_HEADER_V2_SIZE))
+        header_fields.append(BOOT_IMAGE_HEADER_V2_SIZE)
 
     if args.header_version > 1:
         if filesize(args.dtb) == 0:
             raise ValueError('DTB image must not be empty.')
 
-        # dtb size in bytes
-        args.output.write(pack('I', filesize(args.dtb)))
-        # dtb physical load address
-        args.output.write(pack('Q', args.base + args.dtb_offset))
+        header_fields.extend([
+            filesize(args.dtb),
+            args.base + args.dtb_offset,
+        ])
 
-    pad_file(args.output, args.pagesize)
+    # The header is packed into a zero-filled page, so the padding comes free.
+    header = bytearray(args.pagesize)
+    BOOT_IMAGE_HEADER_STRUCTS[args.header_version].pack_into(
+        header, 0, *header_fields)
+    args.output.write(header)
     return img_id
 
 
@@ -281,6 +453,13 @@ class AsciizBytes:
     Traceback (most recent call last):
         ...
     argparse.ArgumentTypeError: Encoded asciiz length exceeded: max 4, got 5
+
+    The length is checked in encoded bytes, not in characters.
+
+    >>> AsciizBytes(bufsize=4)('\u00e9\u00e9')
+    Traceback (most recent call last):
+        ...
+    argparse.ArgumentTypeError: Encoded asciiz length exceeded: max 4, got 5
     """
 
     def __init__(self, bufsize):
@@ -295,6 +474,23 @@ class AsciizBytes:
         return arg_bytes
 
 
+class BoardIdElementAction(Action):
+    """Stores the value of a --board_id{N} option into slot N of board_id."""
+
+    def __init__(self, option_strings, dest, index, **kwargs):
+        super().__init__(option_strings, dest, **kwargs)
+        self.index = index
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        board_id = getattr(namespace, self.dest, None)
+        if board_id is None:
+            board_id = [0] * VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE
+        else:
+            board_id = list(board_id)
+        board_id[self.index] = values
+        setattr(namespace, self.dest, board_id)
+
+
 class VendorRamdiskTableBuilder:
     """Vendor ramdisk table builder.
 
@@ -325,13 +521,14 @@ class VendorRamdiskTableBuilder:
         self.ramdisk_names.add(stripped_ramdisk_name)
 
         if board_id is None:
-            board_id = array.array(
-                'I', [0] * VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE)
+            board_id = ZERO_BOARD_ID
         else:
-            board_id = array.array('I', board_id)
-        if len(board_id) != VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE:
-            raise ValueError('board_id size must be '
-                             f'{VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE}')
+            if len(board_id) != VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE:
+                raise ValueError('board_id size must be '
+                                 f'{VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE}')
+            # Stores the board_id in its on-disk, little-endian layout.
+            board_id = VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_STRUCT.pack(
+                *board_id)
 
         with open(ramdisk_path, 'rb') as f:
             ramdisk_size = filesize(f)
@@ -343,24 +540,25 @@ class VendorRamdiskTableBuilder:
     def write_ramdisks_padded(self, fout, alignment):
         for entry in self.entries:
             with open(entry.ramdisk_path, 'rb') as f:
-                fout.write(f.read())
+                write_file(fout, f)
         pad_file(fout, alignment)
 
     def write_entries_padded(self, fout, alignment):
-        for entry in self.entries:
-            fout.write(pack('I', entry.ramdisk_size))
-            fout.write(pack('I', entry.ramdisk_offset))
-            fout.write(pack('I', entry.ramdisk_type))
-            fout.write(pack(f'{VENDOR_RAMDISK_NAME_SIZE}s',
-                            entry.ramdisk_name))
-            fout.write(entry.board_id)
+        entry_struct = VENDOR_RAMDISK_TABLE_ENTRY_V4_STRUCT
+        table = bytearray(entry_struct.size * len(self.entries))
+        for i, entry in enumerate(self.entries):
+            entry_struct.pack_into(
+                table, i * entry_struct.size,
+                entry.ramdisk_size, entry.ramdisk_offset, entry.ramdisk_type,
+                entry.ramdisk_name, entry.board_id)
+        fout.write(table)
         pad_file(fout, alignment)
 
 
 def write_padded_file(f_out, f_in, padding):
     if f_in is None:
         return
-    f_out.write(f_in.read())
+    write_file(f_out, f_in)
     pad_file(f_out, padding)
 
 
@@ -369,7 +567,7 @@ def parse_int(x):
 
 
 def parse_os_version(x):
-    match = re.search(r'^(\d{1,3})(?:\.(\d{1,3})(?:\.(\d{1,3}))?)?', x)
+    match = OS_VERSION_RE.match(x)
     if match:
         a = int(match.group(1))
         b = c = 0
@@ -386,7 +584,7 @@ def parse_os_version(x):
 
 
 def parse_os_patch_level(x):
-    match = re.search(r'^(\d{4})-(\d{2})(?:-(\d{2}))?', x)
+    match = OS_PATCH_LEVEL_RE.match(x)
     if match:
         y = int(match.group(1)) - 2000
         m = int(match.group(2))
@@ -415,6 +613,8 @@ def get_vendor_boot_v4_usage():
                         specify the type of the ramdisk
   --ramdisk_name NAME
                         specify the name of the ramdisk
+  --board_id NUMBER0 NUMBER1 ... NUMBER15
+                        specify the whole board_id vector, exactly 16 NUMBERs
   --board_id{0..15} NUMBER
                         specify the value of the board_id vector, defaults to 0
   --vendor_ramdisk_fragment VENDOR_RAMDISK_FILE
@@ -423,6 +623,8 @@ def get_vendor_boot_v4_usage():
   These options can be specified multiple times, where each vendor ramdisk
   option group ends with a --vendor_ramdisk_fragment option.
   Each option group appends an additional ramdisk to the vendor boot image.
+  If --board_id and --board_id{0..15} are mixed in an option group, they are
+  applied in order, so the last option that sets a board_id value wins.
 """
 
 
@@ -443,8 +645,11 @@ def parse_vendor_ramdisk_args(args, args_list):
     parser.add_argument('--ramdisk_name',
                         type=AsciizBytes(bufsize=VENDOR_RAMDISK_NAME_SIZE),
                         required=True)
+    parser.add_argument('--board_id', type=parse_int,
+                        nargs=VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE)
     for i in range(VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE):
-        parser.add_argument(f'--board_id{i}', type=parse_int, default=0)
+        parser.add_argument(f'--board_id{i}', dest='board_id', type=parse_int,
+                            action=BoardIdElementAction, index=i)
     parser.add_argument(PARSER_ARGUMENT_VENDOR_RAMDISK_FRAGMENT, required=True)
 
     unknown_args = []
@@ -454,25 +659,29 @@ def parse_vendor_ramdisk_args(args, args_list):
         vendor_ramdisk_table_builder.add_entry(
             args.vendor_ramdisk.name, VENDOR_RAMDISK_TYPE_PLATFORM, b'', None)
 
-    while PARSER_ARGUMENT_VENDOR_RAMDISK_FRAGMENT in args_list:
-        idx = args_list.index(PARSER_ARGUMENT_VENDOR_RAMDISK_FRAGMENT) + 2
-        vendor_ramdisk_args = args_list[:idx]
-        args_list = args_list[idx:]
+    # Each option group ends with the value of a --vendor_ramdisk_fragment.
+    # Scans |args_list| once, from the end of the previous group.
+    group_start = 0
+    while True:
+        try:
+            idx = args_list.index(PARSER_ARGUMENT_VENDOR_RAMDISK_FRAGMENT,
+                                  group_start) + 2
+        except ValueError:
+            break
+        vendor_ramdisk_args = args_list[group_start:idx]
+        group_start = idx
 
         ramdisk_args, extra_args = parser.parse_known_args(vendor_ramdisk_args)
-        ramdisk_args_dict = vars(ramdisk_args)
         unknown_args.extend(extra_args)
 
         ramdisk_path = ramdisk_args.vendor_ramdisk_fragment
         ramdisk_type = ramdisk_args.ramdisk_type
         ramdisk_name = ramdisk_args.ramdisk_name
-        board_id = [ramdisk_args_dict[f'board_id{i}']
-                    for i in range(VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE)]
+        board_id = ramdisk_args.board_id
         vendor_ramdisk_table_builder.add_entry(ramdisk_path, ramdisk_type,
                                                ramdisk_name, board_id)
 
-    if len(args_list) > 0:
-        unknown_args.extend(args_list)
+    unknown_args.extend(args_list[group_start:])
 
     args.vendor_ramdisk_total_size = (vendor_ramdisk_table_builder
                                       .ramdisk_total_size)
@@ -539,12 +748,21 @@ def parse_cmdline():
                         help='page size')
     parser.add_argument('--id', action='store_true',
                         help='print the image ID on standard output')
+    parser.add_argument('--image_id_hash', choices=['sha1', 'blake2b'],
+                        default='sha1',
+                        help='hash algorithm used to compute the image ID of '
+                             'boot image header v0-v2. The algorithm is not '
+                             'recorded in the image, so unpack_bootimg '
+                             '--format=mkbootimg and repack_bootimg rebuild '
+                             'a blake2b image with a sha1 ID')
     parser.add_argument('--header_version', type=parse_int, default=0,
                         help='boot image header version')
     parser.add_argument('--dt', help='path to the device tree image', type=FileType('rb'))
-    parser.add_argument('-o', '--output', type=FileType('wb'),
+    parser.add_argument('-o', '--output',
+                        type=FileType('wb', bufsize=IO_CHUNK_SIZE),
                         help='output file name')
-    parser.add_argument('--vendor_boot', type=FileType('wb'),
+    parser.add_argument('--vendor_boot',
+                        type=FileType('wb', bufsize=IO_CHUNK_SIZE),
                         help='vendor boot output file name')
     parser.add_argument('--vendor_ramdisk', type=FileType('rb'),
                         help='path to the vendor ramdisk')
@@ -665,7 +883,7 @@ def main():
         else:
             write_data(args, args.pagesize)
         if args.id and img_id is not None:
-            print('0x' + ''.join(f'{octet:02x}' for octet in img_id))
+            print('0x' + img_id.hex())
 
 
 if __name__ == '__main__':
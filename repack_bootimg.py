@@ -21,49 +21,105 @@ the ramdisk to repack the boot image.
 """
 
 import argparse
+import concurrent.futures
 import datetime
 import enum
-import glob
+import fcntl
+import filecmp
+import gzip
 import os
 import shlex
 import shutil
+import stat
 import subprocess
 import tempfile
+import zlib
+
+
+# Magic numbers of the supported ramdisk compression formats.
+LZ4_LEGACY_MAGIC = b'\x02\x21\x4c\x18'
+LZ4_FRAME_MAGIC = b'\x04\x22\x4d\x18'
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+# Buffer size of the pipes that ramdisks are streamed through.
+PIPE_BUFSIZE = 1024 * 1024
+
+
+def _grow_pipe(pipe):
+    """Grows the kernel buffer of |pipe| to PIPE_BUFSIZE, where supported."""
+    try:
+        fcntl.fcntl(pipe.fileno(), fcntl.F_SETPIPE_SZ, PIPE_BUFSIZE)
+    except (AttributeError, OSError):
+        # F_SETPIPE_SZ is Linux only, and unprivileged processes are capped
+        # by /proc/sys/fs/pipe-max-size.
+        pass
+
+
+def _is_same_regular_file(src_pathname, dst_pathname):
+    """Returns whether two regular files have the same mode and content."""
+    try:
+        src_stat = os.lstat(src_pathname)
+        dst_stat = os.lstat(dst_pathname)
+    except FileNotFoundError:
+        return False
+    return (stat.S_ISREG(src_stat.st_mode) and
+            src_stat.st_mode == dst_stat.st_mode and
+            filecmp.cmp(src_pathname, dst_pathname, shallow=False))
+
+
+def _wait_pipeline(*procs):
+    """Waits for the processes of a pipeline and checks their exit status.
+
+    Raises:
+        subprocess.CalledProcessError: A process exited with non-zero status.
+    """
+    for proc in procs:
+        proc.wait()
+    for proc in procs:
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
 
 
 class TempFileManager:
-    """Manages temporary files and dirs."""
+    """Manages temporary files and dirs.
+
+    All of them are created in a single temporary dir, which is removed as a
+    whole by close(). One instance is shared by all the images of a run, and
+    can be used as a context manager.
+    """
 
     def __init__(self):
-        self._temp_files = []
+        self._temp_dir = tempfile.mkdtemp(prefix='repack_bootimg_')
+
+    def __enter__(self):
+        return self
 
-    def __del__(self):
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
         """Removes temp dirs and files."""
-        for f in self._temp_files:
-            if os.path.isdir(f):
-                shutil.rmtree(f, ignore_errors=True)
-            else:
-                os.remove(f)
+        shutil.rmtree(self._temp_dir, ignore_errors=True)
 
     def make_temp_dir(self, prefix='tmp', suffix=''):
-        """Makes a temporary dir that will be cleaned up in the destructor.
+        """Makes a temporary dir that will be cleaned up by close().
 
         Returns:
             The absolute pathname of the new directory.
         """
-        dir_name = tempfile.mkdtemp(prefix=prefix, suffix=suffix)
-        self._temp_files.append(dir_name)
-        return dir_name
+        return tempfile.mkdtemp(prefix=prefix, suffix=suffix,
+                                dir=self._temp_dir)
 
     def make_temp_file(self, prefix='tmp', suffix=''):
-        """Make a temp file that will be deleted in the destructor.
+        """Make a temp file that will be deleted by close().
 
         Returns:
             The absolute pathname of the new file.
         """
-        fd, file_name = tempfile.mkstemp(prefix=prefix, suffix=suffix)
+        fd, file_name = tempfile.mkstemp(prefix=prefix, suffix=suffix,
+                                         dir=self._temp_dir)
         os.close(fd)
-        self._temp_files.append(file_name)
         return file_name
 
 
@@ -83,11 +139,13 @@ class BootImageType(enum.Enum):
 
 class RamdiskImage:
     """A class that supports packing/unpacking a ramdisk."""
-    def __init__(self, ramdisk_img, unpack=True):
+    def __init__(self, ramdisk_img, temp_file_manager, unpack=True):
         self._ramdisk_img = ramdisk_img
         self._ramdisk_format = None
         self._ramdisk_dir = None
-        self._temp_file_manager = TempFileManager()
+        self._temp_file_manager = temp_file_manager
+        # A new ramdisk always has to be packed.
+        self._dirty = not unpack
 
         if unpack:
             self._unpack_ramdisk()
@@ -101,59 +159,119 @@ class RamdiskImage:
             suffix='_' + os.path.basename(self._ramdisk_img))
 
         # The compression format might be in 'lz4' or 'gzip' format,
-        # trying lz4 first.
-        for compression_type, compression_util in [
-            (RamdiskFormat.LZ4, 'lz4'),
-            (RamdiskFormat.GZIP, 'gzip')]:
+        # which is detected from the magic number of the ramdisk.
+        with open(self._ramdisk_img, 'rb') as ramdisk_file:
+            magic = ramdisk_file.read(4)
+        if magic in (LZ4_LEGACY_MAGIC, LZ4_FRAME_MAGIC):
+            self._ramdisk_format = RamdiskFormat.LZ4
+        elif magic.startswith(GZIP_MAGIC):
+            self._ramdisk_format = RamdiskFormat.GZIP
+        else:
+            raise RuntimeError('Failed to decompress ramdisk.')
+
+        # toybox cpio arguments:
+        #   -i: extract files from stdin
+        #   -d: create directories if needed
+        #   -u: override existing files
+        cpio_cmd = ['toybox', 'cpio', '-idu']
 
+        if self._ramdisk_format == RamdiskFormat.LZ4:
             # Command arguments:
             #   -d: decompression
             #   -c: write to stdout
-            decompression_cmd = [
-                compression_util, '-d', '-c', self._ramdisk_img]
-
-            decompressed_result = subprocess.run(
-                decompression_cmd, check=False, capture_output=True)
-
-            if decompressed_result.returncode == 0:
-                self._ramdisk_format = compression_type
-                break
-
-        if self._ramdisk_format is not None:
-            # toybox cpio arguments:
-            #   -i: extract files from stdin
-            #   -d: create directories if needed
-            #   -u: override existing files
-            subprocess.run(
-                ['toybox', 'cpio', '-idu'], check=True,
-                input=decompressed_result.stdout, cwd=self._ramdisk_dir)
-
-            print(f"=== Unpacked ramdisk: '{self._ramdisk_img}' at "
-                  f"'{self._ramdisk_dir}' ===")
+            lz4 = subprocess.Popen(['lz4', '-d', '-c', self._ramdisk_img],
+                                   stdout=subprocess.PIPE)
+            _grow_pipe(lz4.stdout)
+            cpio = subprocess.Popen(cpio_cmd, stdin=lz4.stdout,
+                                    cwd=self._ramdisk_dir)
+            lz4.stdout.close()
+            _wait_pipeline(lz4, cpio)
         else:
-            raise RuntimeError('Failed to decompress ramdisk.')
-
-    def repack_ramdisk(self, out_ramdisk_file):
+            # gzip is decompressed in-process, without another subprocess.
+            cpio = subprocess.Popen(cpio_cmd, stdin=subprocess.PIPE,
+                                    bufsize=PIPE_BUFSIZE,
+                                    cwd=self._ramdisk_dir)
+            _grow_pipe(cpio.stdin)
+            try:
+                with cpio.stdin, gzip.open(self._ramdisk_img) as gzip_file:
+                    shutil.copyfileobj(gzip_file, cpio.stdin, PIPE_BUFSIZE)
+            except BrokenPipeError:
+                # cpio exited early, its exit status is checked below.
+                pass
+            except (OSError, EOFError, zlib.error) as e:
+                cpio.kill()
+                raise RuntimeError('Failed to decompress ramdisk.') from e
+            finally:
+                cpio.wait()
+            _wait_pipeline(cpio)
+
+        print(f"=== Unpacked ramdisk: '{self._ramdisk_img}' at "
+              f"'{self._ramdisk_dir}' ===")
+
+    def repack_ramdisk(self, out_ramdisk_file, compression_level=None):
         """Repacks a ramdisk from self._ramdisk_dir.
 
         Args:
             out_ramdisk_file: the output ramdisk file to save.
+            compression_level: the lz4 or gzip compression level, or None to
+                use the default level of the ramdisk format.
         """
-        compression_cmd = ['lz4', '-l', '-12', '--favor-decSpeed']
-        if self._ramdisk_format == RamdiskFormat.GZIP:
-            compression_cmd = ['gzip']
+        if not self._dirty and compression_level is None:
+            # Nothing changed in the ramdisk, so reuses the original one.
+            shutil.copyfile(self._ramdisk_img, out_ramdisk_file)
+            print(f"=== Reused unchanged ramdisk: '{self._ramdisk_img}' ===")
+            return
 
         print('Repacking ramdisk, which might take a few seconds ...')
 
-        mkbootfs_result = subprocess.run(
-            ['mkbootfs', self._ramdisk_dir], check=True, capture_output=True)
-
-        with open(out_ramdisk_file, 'w') as output_fd:
-            subprocess.run(compression_cmd, check=True,
-                           input=mkbootfs_result.stdout, stdout=output_fd)
+        # Streams the mkbootfs output into the compressor, instead of
+        # keeping the whole cpio archive in memory.
+        with open(out_ramdisk_file, 'wb', buffering=PIPE_BUFSIZE) as output_fd:
+            mkbootfs = subprocess.Popen(['mkbootfs', self._ramdisk_dir],
+                                        stdout=subprocess.PIPE,
+                                        bufsize=PIPE_BUFSIZE)
+            _grow_pipe(mkbootfs.stdout)
+            try:
+                self._compress_ramdisk(mkbootfs, output_fd, compression_level)
+            finally:
+                # Doesn't leave mkbootfs behind if the output or compressor
+                # fails. It has already been waited for on success.
+                mkbootfs.stdout.close()
+                if mkbootfs.returncode is None:
+                    mkbootfs.kill()
+                mkbootfs.wait()
 
         print("=== Repacked ramdisk: '{}' ===".format(out_ramdisk_file))
 
+    def _compress_ramdisk(self, mkbootfs, output_fd, compression_level):
+        """Compresses the mkbootfs output into |output_fd|."""
+        if self._ramdisk_format == RamdiskFormat.GZIP:
+            # Defaults to the level of the gzip command, and writes no
+            # timestamp, so the repacked ramdisk is reproducible.
+            if compression_level is None:
+                compression_level = 6
+            with gzip.GzipFile(filename='', mode='wb',
+                               compresslevel=min(compression_level, 9),
+                               fileobj=output_fd, mtime=0) as gzip_file:
+                shutil.copyfileobj(mkbootfs.stdout, gzip_file, PIPE_BUFSIZE)
+            mkbootfs.stdout.close()
+            _wait_pipeline(mkbootfs)
+        else:
+            if compression_level is None:
+                compression_level = 12
+            compression_cmd = ['lz4', '-l', f'-{compression_level}']
+            # --favor-decSpeed only applies to the lz4 HC levels.
+            if compression_level >= 10:
+                compression_cmd.append('--favor-decSpeed')
+            lz4 = subprocess.Popen(compression_cmd, stdin=mkbootfs.stdout,
+                                   stdout=output_fd)
+            mkbootfs.stdout.close()
+            _wait_pipeline(mkbootfs, lz4)
+
+    def mark_dirty(self):
+        """Marks that self._ramdisk_dir was modified and must be repacked."""
+        self._dirty = True
+
     @property
     def ramdisk_dir(self):
         """Returns the internal ramdisk dir."""
@@ -163,20 +281,25 @@ class RamdiskImage:
 class BootImage:
     """A class that supports packing/unpacking a boot.img and ramdisk."""
 
-    def __init__(self, bootimg):
+    def __init__(self, bootimg, temp_file_manager):
         self._bootimg = bootimg
         self._bootimg_dir = None
         self._bootimg_type = None
         self._ramdisk = None
         self._previous_mkbootimg_args = []
-        self._temp_file_manager = TempFileManager()
+        self._temp_file_manager = temp_file_manager
 
         self._unpack_bootimg()
 
-    def _get_vendor_ramdisks(self):
-        """Returns a list of vendor ramdisks after unpack."""
-        return sorted(glob.glob(
-            os.path.join(self._bootimg_dir, 'vendor_ramdisk*')))
+    def _get_vendor_ramdisks(self, unpacked_files):
+        """Returns a list of vendor ramdisks after unpack.
+
+        Args:
+            unpacked_files: the set of file names in self._bootimg_dir.
+        """
+        return sorted(os.path.join(self._bootimg_dir, name)
+                      for name in unpacked_files
+                      if name.startswith('vendor_ramdisk'))
 
     def _unpack_bootimg(self):
         """Unpacks the boot.img and the ramdisk inside."""
@@ -189,40 +312,55 @@ class BootImage:
             '--boot_img', self._bootimg,
             '--out', self._bootimg_dir,
             '--format=mkbootimg',
+            '--null',
         ]
         result = subprocess.run(unpack_bootimg_cmds, check=True,
                                 capture_output=True, encoding='utf-8')
-        self._previous_mkbootimg_args = shlex.split(result.stdout)
+        # Each argument is terminated by a null, so they can be split without
+        # the shell-like parsing of shlex.
+        self._previous_mkbootimg_args = result.stdout.split('\0')[:-1]
         print("=== Unpacked boot image: '{}' ===".format(self._bootimg))
 
         # From the output dir, checks there is 'ramdisk' or 'vendor_ramdisk'.
+        # Lists the dir once, instead of checking each name separately.
+        with os.scandir(self._bootimg_dir) as entries:
+            unpacked_files = {entry.name for entry in entries}
         ramdisk = os.path.join(self._bootimg_dir, 'ramdisk')
         vendor_ramdisk = os.path.join(self._bootimg_dir, 'vendor_ramdisk')
-        vendor_ramdisks = self._get_vendor_ramdisks()
-        if os.path.exists(ramdisk):
-            self._ramdisk = RamdiskImage(ramdisk)
+        vendor_ramdisks = self._get_vendor_ramdisks(unpacked_files)
+        if 'ramdisk' in unpacked_files:
+            self._ramdisk = RamdiskImage(ramdisk, self._temp_file_manager)
             self._bootimg_type = BootImageType.BOOT_IMAGE
-        elif os.path.exists(vendor_ramdisk):
-            self._ramdisk = RamdiskImage(vendor_ramdisk)
+        elif 'vendor_ramdisk' in unpacked_files:
+            self._ramdisk = RamdiskImage(vendor_ramdisk,
+                                         self._temp_file_manager)
             self._bootimg_type = BootImageType.VENDOR_BOOT_IMAGE
         elif len(vendor_ramdisks) == 1:
-            self._ramdisk = RamdiskImage(vendor_ramdisks[0])
+            self._ramdisk = RamdiskImage(vendor_ramdisks[0],
+                                         self._temp_file_manager)
             self._bootimg_type = BootImageType.SINGLE_RAMDISK_FRAGMENT
         elif len(vendor_ramdisks) > 1:
             # Creates an empty RamdiskImage() below, without unpack.
             # We'll then add files into this newly created ramdisk, then pack
             # it with other vendor ramdisks together.
-            self._ramdisk = RamdiskImage(ramdisk_img=None, unpack=False)
+            self._ramdisk = RamdiskImage(
+                ramdisk_img=None, temp_file_manager=self._temp_file_manager,
+                unpack=False)
             self._bootimg_type = BootImageType.MULTIPLE_RAMDISK_FRAGMENTS
         else:
             raise RuntimeError('Both ramdisk and vendor_ramdisk do not exist.')
 
-    def repack_bootimg(self):
-        """Repacks the ramdisk and rebuild the boot.img"""
+    def repack_bootimg(self, compression_level=None):
+        """Repacks the ramdisk and rebuild the boot.img
+
+        Args:
+            compression_level: the ramdisk compression level, or None to use
+                the default level of the ramdisk format.
+        """
 
         new_ramdisk = self._temp_file_manager.make_temp_file(
             prefix='ramdisk-patched')
-        self._ramdisk.repack_ramdisk(new_ramdisk)
+        self._ramdisk.repack_ramdisk(new_ramdisk, compression_level)
 
         mkbootimg_cmd = ['mkbootimg']
 
@@ -265,17 +403,36 @@ class BootImage:
         Args:
             copy_pairs: a list of (src_pathname, dst_file) pairs.
         """
-        # Creates missing parent dirs with 0o755.
+        copy_pathnames = [
+            (src_pathname, os.path.join(self.ramdisk_dir, dst_file))
+            for src_pathname, dst_file in copy_pairs
+        ]
+
+        # Creates missing parent dirs with 0o755, checking each dir once.
+        # The umask still matters: it applies to the mode of os.makedirs(),
+        # including the intermediate dirs.
         original_mask = os.umask(0o022)
-        for src_pathname, dst_file in copy_pairs:
-            dst_pathname = os.path.join(self.ramdisk_dir, dst_file)
-            dst_dir = os.path.dirname(dst_pathname)
-            if not os.path.exists(dst_dir):
-                print("Creating dir '{}'".format(dst_dir))
-                os.makedirs(dst_dir, 0o755)
+        try:
+            for dst_dir in sorted({os.path.dirname(dst_pathname)
+                                   for _, dst_pathname in copy_pathnames}):
+                try:
+                    os.makedirs(dst_dir, 0o755)
+                except FileExistsError:
+                    continue
+                print("Created dir '{}'".format(dst_dir))
+                self._ramdisk.mark_dirty()
+        finally:
+            os.umask(original_mask)
+
+        # shutil.copy2() already copies the data with sendfile() on Linux, and
+        # sets the mode of the copy from the source file.
+        for src_pathname, dst_pathname in copy_pathnames:
+            if _is_same_regular_file(src_pathname, dst_pathname):
+                print(f"Skipping unchanged file '{dst_pathname}'")
+                continue
+            self._ramdisk.mark_dirty()
             print(f"Copying file '{src_pathname}' to '{dst_pathname}'")
             shutil.copy2(src_pathname, dst_pathname, follow_symlinks=False)
-        os.umask(original_mask)
 
     @property
     def ramdisk_dir(self):
@@ -317,7 +474,7 @@ def _get_repack_usage():
 """
 
 
-def _parse_args():
+def _parse_args(temp_file_manager):
     """Parse command-line options."""
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -328,22 +485,38 @@ def _parse_args():
 
     src_group = parser.add_mutually_exclusive_group(required=True)
     src_group.add_argument(
-        '--src_bootimg', help='filename to source boot image',
-        type=BootImage)
+        '--src_bootimg', help='filename to source boot image')
     src_group.add_argument(
         '--local', help='use local files as repack source',
         action='store_true')
 
     parser.add_argument(
         '--dst_bootimg', help='filename to destination boot image',
-        type=BootImage, required=True)
+        required=True)
     parser.add_argument(
         '--ramdisk_add', metavar='SRC_FILE:DST_FILE',
         help='a copy pair to copy into the ramdisk of --dst_bootimg',
         action='extend', nargs='+', required=True)
+    parser.add_argument(
+        '--ramdisk_compression_level', metavar='LEVEL', type=int,
+        choices=range(1, 13),
+        help='lz4 (1-12) or gzip (1-9, higher levels use 9) level to '
+             'recompress the ramdisk with; defaults to 12 for lz4 and 6 for '
+             'gzip')
 
     args = parser.parse_args()
 
+    # Unpacks the boot images concurrently, as each of them mostly waits for
+    # the unpack_bootimg, decompression and cpio subprocesses.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        dst_future = executor.submit(BootImage, args.dst_bootimg,
+                                     temp_file_manager)
+        if args.src_bootimg:
+            src_future = executor.submit(BootImage, args.src_bootimg,
+                                         temp_file_manager)
+            args.src_bootimg = src_future.result()
+        args.dst_bootimg = dst_future.result()
+
     # Parse args.ramdisk_add to a list of copy pairs.
     if args.src_bootimg:
         args.ramdisk_add = [
@@ -385,9 +558,10 @@ def _parse_ramdisk_copy_pair(pair, src_ramdisk_dir=None):
 
 def main():
     """Parse arguments and repack boot image."""
-    args = _parse_args()
-    args.dst_bootimg.add_files(args.ramdisk_add)
-    args.dst_bootimg.repack_bootimg()
+    with TempFileManager() as temp_file_manager:
+        args = _parse_args(temp_file_manager)
+        args.dst_bootimg.add_files(args.ramdisk_add)
+        args.dst_bootimg.repack_bootimg(args.ramdisk_compression_level)
 
 
 if __name__ == '__main__':
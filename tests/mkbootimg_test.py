@@ -17,11 +17,14 @@
 """Tests mkbootimg and unpack_bootimg."""
 
 import filecmp
+import hashlib
 import logging
 import os
 import random
 import shlex
+import shutil
 import subprocess
+import struct
 import sys
 import tempfile
 import unittest
@@ -48,6 +51,13 @@ def generate_test_file(pathname, size, seed=None):
     return pathname
 
 
+def read_file_range(pathname, offset, size):
+    """Returns up to |size| bytes of the file at |offset|."""
+    with open(pathname, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
 def subsequence_of(list1, list2):
     """Returns True if list1 is a subsequence of list2.
 
@@ -58,18 +68,39 @@ def subsequence_of(list1, list2):
     >>> subsequence_of([1, 2, 2], [1, 2, 3])
     False
     """
-    if len(list1) == 0:
-        return True
-    if len(list2) == 0:
-        return False
-    if list1[0] == list2[0]:
-        return subsequence_of(list1[1:], list2[1:])
-    return subsequence_of(list1, list2[1:])
+    # Each element of list1 consumes list2 up to its first match, so the
+    # matches are in order.
+    it = iter(list2)
+    return all(any(x == y for y in it) for x in list1)
 
 
 class MkbootimgTest(unittest.TestCase):
     """Tests the functionalities of mkbootimg and unpack_bootimg."""
 
+    @classmethod
+    def setUpClass(cls):
+        # The generated test input files only depend on their name and size,
+        # so they're generated once and shared by all the tests.
+        cls._test_files_dir = tempfile.TemporaryDirectory()
+        cls._test_files = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._test_files_dir.cleanup()
+
+    def _get_test_file(self, name, size):
+        """Returns the pathname of a shared generated test file.
+
+        The tests must not modify the returned file.
+        """
+        key = (name, size)
+        if key not in self._test_files:
+            size_dir = os.path.join(self._test_files_dir.name, f'{size:#x}')
+            os.makedirs(size_dir, exist_ok=True)
+            self._test_files[key] = generate_test_file(
+                os.path.join(size_dir, name), size)
+        return self._test_files[key]
+
     def setUp(self):
         # Saves the test executable directory so that relative path references
         # to test dependencies don't rely on being manually run from the
@@ -84,14 +115,22 @@ class MkbootimgTest(unittest.TestCase):
         # C0103: invalid-name for maxDiff.
         self.maxDiff = None  # pylint: disable=C0103
 
+    def _skip_unless_avbtool(self, avbtool_path=None):
+        """Skips the test if avbtool_path, or avbtool on PATH, isn't found.
+
+        This avoids launching mkbootimg just to fail on a missing avbtool.
+        """
+        avbtool = avbtool_path or 'avbtool'
+        if shutil.which(avbtool) is None:
+            self.skipTest(f'{avbtool} is not available')
+
     def _test_legacy_boot_image_v4_signature(self, avbtool_path):
         """Tests the boot_signature in boot.img v4."""
+        self._skip_unless_avbtool(avbtool_path)
         with tempfile.TemporaryDirectory() as temp_out_dir:
             boot_img = os.path.join(temp_out_dir, 'boot.img')
-            kernel = generate_test_file(os.path.join(temp_out_dir, 'kernel'),
-                                        0x1000)
-            ramdisk = generate_test_file(os.path.join(temp_out_dir, 'ramdisk'),
-                                         0x1000)
+            kernel = self._get_test_file('kernel', 0x1000)
+            ramdisk = self._get_test_file('ramdisk', 0x1000)
             mkbootimg_cmds = [
                 'mkbootimg',
                 '--header_version', '4',
@@ -119,8 +158,10 @@ class MkbootimgTest(unittest.TestCase):
 
             # cwd=self._exec_dir is required to read
             # ./tests/data/testkey_rsa2048.pem for --gki_signing_key.
-            subprocess.run(mkbootimg_cmds, check=True, cwd=self._exec_dir)
-            subprocess.run(unpack_bootimg_cmds, check=True)
+            subprocess.run(mkbootimg_cmds, check=True, cwd=self._exec_dir,
+                           stdout=subprocess.DEVNULL)
+            subprocess.run(unpack_bootimg_cmds, check=True,
+                           stdout=subprocess.DEVNULL)
 
             # Checks the content of the boot signature.
             expected_boot_signature_info = (
@@ -171,12 +212,11 @@ class MkbootimgTest(unittest.TestCase):
 
     def test_legacy_boot_image_v4_signature_exceed_size(self):
         """Tests the boot signature size exceeded in a boot image version 4."""
+        self._skip_unless_avbtool(self._avbtool_path)
         with tempfile.TemporaryDirectory() as temp_out_dir:
             boot_img = os.path.join(temp_out_dir, 'boot.img')
-            kernel = generate_test_file(os.path.join(temp_out_dir, 'kernel'),
-                                        0x1000)
-            ramdisk = generate_test_file(os.path.join(temp_out_dir, 'ramdisk'),
-                                         0x1000)
+            kernel = self._get_test_file('kernel', 0x1000)
+            ramdisk = self._get_test_file('ramdisk', 0x1000)
             mkbootimg_cmds = [
                 'mkbootimg',
                 '--header_version', '4',
@@ -197,7 +237,9 @@ class MkbootimgTest(unittest.TestCase):
             # cwd=self._exec_dir is required to read
             # ./tests/data/testkey_rsa2048.pem for --gki_signing_key.
             try:
-                subprocess.run(mkbootimg_cmds, check=True, capture_output=True,
+                subprocess.run(mkbootimg_cmds, check=True,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE,
                                cwd=self._exec_dir, encoding='utf-8')
                 self.fail('Exceeding signature size assertion is not raised')
             except subprocess.CalledProcessError as e:
@@ -208,10 +250,8 @@ class MkbootimgTest(unittest.TestCase):
         """Tests no boot signature in a boot image version 4."""
         with tempfile.TemporaryDirectory() as temp_out_dir:
             boot_img = os.path.join(temp_out_dir, 'boot.img')
-            kernel = generate_test_file(os.path.join(temp_out_dir, 'kernel'),
-                                        0x1000)
-            ramdisk = generate_test_file(os.path.join(temp_out_dir, 'ramdisk'),
-                                         0x1000)
+            kernel = self._get_test_file('kernel', 0x1000)
+            ramdisk = self._get_test_file('ramdisk', 0x1000)
 
             mkbootimg_cmds = [
                 'mkbootimg',
@@ -229,25 +269,67 @@ class MkbootimgTest(unittest.TestCase):
                 '--out', os.path.join(temp_out_dir, 'out'),
             ]
 
-            subprocess.run(mkbootimg_cmds, check=True)
-            subprocess.run(unpack_bootimg_cmds, check=True)
+            subprocess.run(mkbootimg_cmds, check=True,
+                           stdout=subprocess.DEVNULL)
+            subprocess.run(unpack_bootimg_cmds, check=True,
+                           stdout=subprocess.DEVNULL)
 
             # The boot signature will be empty if no
             # --gki_signing_[algorithm|key] is provided.
             boot_signature = os.path.join(temp_out_dir, 'out', 'boot_signature')
             self.assertFalse(os.path.exists(boot_signature))
 
+    def test_boot_image_v2_blake2b_image_id(self):
+        """Tests the image ID of --image_id_hash blake2b."""
+        # The image ID is after magic, 10 uint32s, board name and cmdline.
+        image_id_offset = 8 + 10 * 4 + 16 + 512
+        with tempfile.TemporaryDirectory() as temp_out_dir:
+            boot_img = os.path.join(temp_out_dir, 'boot.img')
+            kernel = self._get_test_file('kernel', 0x1000)
+            ramdisk = self._get_test_file('ramdisk', 0x1000)
+            second = self._get_test_file('second', 0x1000)
+            recovery_dtbo = self._get_test_file('recovery_dtbo', 0x1000)
+            dtb = self._get_test_file('dtb', 0x1000)
+            mkbootimg_cmds = [
+                'mkbootimg',
+                '--header_version', '2',
+                '--kernel', kernel,
+                '--ramdisk', ramdisk,
+                '--second', second,
+                '--recovery_dtbo', recovery_dtbo,
+                '--dtb', dtb,
+                '--image_id_hash', 'blake2b',
+                '--output', boot_img,
+            ]
+            subprocess.run(mkbootimg_cmds, check=True,
+                           stdout=subprocess.DEVNULL)
+
+            # Each input is hashed followed by its size, and the missing
+            # --dt is hashed as a zero size.
+            expected_hasher = hashlib.blake2b(digest_size=20)
+            for pathname in [kernel, ramdisk, second, None, recovery_dtbo,
+                             dtb]:
+                if pathname is None:
+                    expected_hasher.update(struct.pack('<I', 0))
+                    continue
+                with open(pathname, 'rb') as f:
+                    data = f.read()
+                expected_hasher.update(data)
+                expected_hasher.update(struct.pack('<I', len(data)))
+            expected_img_id = expected_hasher.digest().ljust(32, b'\0')
+
+            self.assertEqual(
+                expected_img_id,
+                read_file_range(boot_img, image_id_offset, 32))
+
     def test_vendor_boot_v4(self):
         """Tests vendor_boot version 4."""
         with tempfile.TemporaryDirectory() as temp_out_dir:
             vendor_boot_img = os.path.join(temp_out_dir, 'vendor_boot.img')
-            dtb = generate_test_file(os.path.join(temp_out_dir, 'dtb'), 0x1000)
-            ramdisk1 = generate_test_file(
-                os.path.join(temp_out_dir, 'ramdisk1'), 0x1000)
-            ramdisk2 = generate_test_file(
-                os.path.join(temp_out_dir, 'ramdisk2'), 0x2000)
-            bootconfig = generate_test_file(
-                os.path.join(temp_out_dir, 'bootconfig'), 0x1000)
+            dtb = self._get_test_file('dtb', 0x1000)
+            ramdisk1 = self._get_test_file('ramdisk1', 0x1000)
+            ramdisk2 = self._get_test_file('ramdisk2', 0x2000)
+            bootconfig = self._get_test_file('bootconfig', 0x1000)
             mkbootimg_cmds = [
                 'mkbootimg',
                 '--header_version', '4',
@@ -295,7 +377,8 @@ class MkbootimgTest(unittest.TestCase):
                 'vendor bootconfig size: 4096',
             ]
 
-            subprocess.run(mkbootimg_cmds, check=True)
+            subprocess.run(mkbootimg_cmds, check=True,
+                           stdout=subprocess.DEVNULL)
             result = subprocess.run(unpack_bootimg_cmds, check=True,
                                     capture_output=True, encoding='utf-8')
             output = [line.strip() for line in result.stdout.splitlines()]
@@ -310,19 +393,58 @@ class MkbootimgTest(unittest.TestCase):
                 ])
                 self.fail(msg)
 
+    def test_vendor_boot_v4_board_id_vector(self):
+        """Tests that --board_id sets the same vector as --board_id{N}.
+
+        When both forms are mixed, the last option wins for each slot.
+        """
+        with tempfile.TemporaryDirectory() as temp_out_dir:
+            ramdisk = self._get_test_file('ramdisk', 0x1000)
+            board_id = ['0'] * 16
+            board_id[0] = '0xC0FFEE'
+            board_id[15] = '0x15151515'
+            board_id_args = {
+                'element': ['--board_id0', '0xC0FFEE',
+                            '--board_id15', '0x15151515'],
+                'vector': ['--board_id'] + board_id,
+                # --board_id overrides the earlier --board_id0, and is then
+                # partly overridden by the later --board_id{N}.
+                'mixed': ['--board_id0', '0xDEAD',
+                          '--board_id', *['0'] * 15, '0x1',
+                          '--board_id15', '0x15151515',
+                          '--board_id0', '0xC0FFEE'],
+            }
+            vendor_boot_imgs = []
+            for name, args in board_id_args.items():
+                vendor_boot_img = os.path.join(temp_out_dir, f'{name}.img')
+                mkbootimg_cmds = [
+                    'mkbootimg',
+                    '--header_version', '4',
+                    '--vendor_boot', vendor_boot_img,
+                    '--ramdisk_name', 'RAMDISK',
+                    *args,
+                    '--vendor_ramdisk_fragment', ramdisk,
+                ]
+                subprocess.run(mkbootimg_cmds, check=True,
+                               stdout=subprocess.DEVNULL)
+                vendor_boot_imgs.append(vendor_boot_img)
+
+            for vendor_boot_img in vendor_boot_imgs[1:]:
+                self.assertTrue(
+                    filecmp.cmp(vendor_boot_imgs[0], vendor_boot_img,
+                                shallow=False),
+                    f'{vendor_boot_img} differs from {vendor_boot_imgs[0]}')
+
     def test_unpack_vendor_boot_image_v4(self):
         """Tests that mkbootimg(unpack_bootimg(image)) is an identity."""
         with tempfile.TemporaryDirectory() as temp_out_dir:
             vendor_boot_img = os.path.join(temp_out_dir, 'vendor_boot.img')
             vendor_boot_img_reconstructed = os.path.join(
                 temp_out_dir, 'vendor_boot.img.reconstructed')
-            dtb = generate_test_file(os.path.join(temp_out_dir, 'dtb'), 0x1000)
-            ramdisk1 = generate_test_file(
-                os.path.join(temp_out_dir, 'ramdisk1'), 0x121212)
-            ramdisk2 = generate_test_file(
-                os.path.join(temp_out_dir, 'ramdisk2'), 0x212121)
-            bootconfig = generate_test_file(
-                os.path.join(temp_out_dir, 'bootconfig'), 0x1000)
+            dtb = self._get_test_file('dtb', 0x1000)
+            ramdisk1 = self._get_test_file('ramdisk1', 0x121212)
+            ramdisk2 = self._get_test_file('ramdisk2', 0x212121)
+            bootconfig = self._get_test_file('bootconfig', 0x1000)
 
             mkbootimg_cmds = [
                 'mkbootimg',
@@ -347,7 +469,8 @@ class MkbootimgTest(unittest.TestCase):
                 '--out', os.path.join(temp_out_dir, 'out'),
                 '--format=mkbootimg',
             ]
-            subprocess.run(mkbootimg_cmds, check=True)
+            subprocess.run(mkbootimg_cmds, check=True,
+                           stdout=subprocess.DEVNULL)
             result = subprocess.run(unpack_bootimg_cmds, check=True,
                                     capture_output=True, encoding='utf-8')
             mkbootimg_cmds = [
@@ -357,7 +480,8 @@ class MkbootimgTest(unittest.TestCase):
             unpack_format_args = shlex.split(result.stdout)
             mkbootimg_cmds.extend(unpack_format_args)
 
-            subprocess.run(mkbootimg_cmds, check=True)
+            subprocess.run(mkbootimg_cmds, check=True,
+                           stdout=subprocess.DEVNULL)
             self.assertTrue(
                 filecmp.cmp(vendor_boot_img, vendor_boot_img_reconstructed),
                 'reconstructed vendor_boot image differ from the original')
@@ -376,9 +500,8 @@ class MkbootimgTest(unittest.TestCase):
             vendor_boot_img = os.path.join(temp_out_dir, 'vendor_boot.img')
             vendor_boot_img_reconstructed = os.path.join(
                 temp_out_dir, 'vendor_boot.img.reconstructed')
-            dtb = generate_test_file(os.path.join(temp_out_dir, 'dtb'), 0x1000)
-            ramdisk = generate_test_file(os.path.join(temp_out_dir, 'ramdisk'),
-                                         0x121212)
+            dtb = self._get_test_file('dtb', 0x1000)
+            ramdisk = self._get_test_file('ramdisk', 0x121212)
             mkbootimg_cmds = [
                 'mkbootimg',
                 '--header_version', '3',
@@ -400,7 +523,8 @@ class MkbootimgTest(unittest.TestCase):
                 '--out', os.path.join(temp_out_dir, 'out'),
                 '--format=mkbootimg',
             ]
-            subprocess.run(mkbootimg_cmds, check=True)
+            subprocess.run(mkbootimg_cmds, check=True,
+                           stdout=subprocess.DEVNULL)
             result = subprocess.run(unpack_bootimg_cmds, check=True,
                                     capture_output=True, encoding='utf-8')
             mkbootimg_cmds = [
@@ -409,29 +533,24 @@ class MkbootimgTest(unittest.TestCase):
             ]
             mkbootimg_cmds.extend(shlex.split(result.stdout))
 
-            subprocess.run(mkbootimg_cmds, check=True)
+            subprocess.run(mkbootimg_cmds, check=True,
+                           stdout=subprocess.DEVNULL)
             self.assertTrue(
                 filecmp.cmp(vendor_boot_img, vendor_boot_img_reconstructed),
                 'reconstructed vendor_boot image differ from the original')
 
-    def test_unpack_boot_image_v4(self):
-        """Tests that mkbootimg(unpack_bootimg(image)) is an identity."""
+    def _test_unpack_boot_image(self, mkbootimg_args):
+        """Tests that mkbootimg(unpack_bootimg(image)) is an identity.
+
+        mkbootimg_args are the arguments, except --output, used to create the
+        original boot image.
+        """
         with tempfile.TemporaryDirectory() as temp_out_dir:
             boot_img = os.path.join(temp_out_dir, 'boot.img')
             boot_img_reconstructed = os.path.join(
                 temp_out_dir, 'boot.img.reconstructed')
-            kernel = generate_test_file(os.path.join(temp_out_dir, 'kernel'),
-                                        0x1000)
-            ramdisk = generate_test_file(os.path.join(temp_out_dir, 'ramdisk'),
-                                         0x1000)
             mkbootimg_cmds = [
-                'mkbootimg',
-                '--header_version', '4',
-                '--kernel', kernel,
-                '--ramdisk', ramdisk,
-                '--cmdline', TEST_KERNEL_CMDLINE,
-                '--output', boot_img,
-            ]
+                'mkbootimg', *mkbootimg_args, '--output', boot_img]
             unpack_bootimg_cmds = [
                 'unpack_bootimg',
                 '--boot_img', boot_img,
@@ -439,7 +558,8 @@ class MkbootimgTest(unittest.TestCase):
                 '--format=mkbootimg',
             ]
 
-            subprocess.run(mkbootimg_cmds, check=True)
+            subprocess.run(mkbootimg_cmds, check=True,
+                           stdout=subprocess.DEVNULL)
             result = subprocess.run(unpack_bootimg_cmds, check=True,
                                     capture_output=True, encoding='utf-8')
             mkbootimg_cmds = [
@@ -448,242 +568,129 @@ class MkbootimgTest(unittest.TestCase):
             ]
             mkbootimg_cmds.extend(shlex.split(result.stdout))
 
-            subprocess.run(mkbootimg_cmds, check=True)
+            subprocess.run(mkbootimg_cmds, check=True,
+                           stdout=subprocess.DEVNULL)
             self.assertTrue(
                 filecmp.cmp(boot_img, boot_img_reconstructed),
                 'reconstructed boot image differ from the original')
 
-    def test_unpack_boot_image_v3(self):
+    def test_unpack_boot_image_v4(self):
         """Tests that mkbootimg(unpack_bootimg(image)) is an identity."""
-        with tempfile.TemporaryDirectory() as temp_out_dir:
-            boot_img = os.path.join(temp_out_dir, 'boot.img')
-            boot_img_reconstructed = os.path.join(
-                temp_out_dir, 'boot.img.reconstructed')
-            kernel = generate_test_file(os.path.join(temp_out_dir, 'kernel'),
-                                        0x1000)
-            ramdisk = generate_test_file(os.path.join(temp_out_dir, 'ramdisk'),
-                                         0x1000)
-            mkbootimg_cmds = [
-                'mkbootimg',
-                '--header_version', '3',
-                '--kernel', kernel,
-                '--ramdisk', ramdisk,
-                '--cmdline', TEST_KERNEL_CMDLINE,
-                '--os_version', '11.0.0',
-                '--os_patch_level', '2021-01',
-                '--output', boot_img,
-            ]
-            unpack_bootimg_cmds = [
-                'unpack_bootimg',
-                '--boot_img', boot_img,
-                '--out', os.path.join(temp_out_dir, 'out'),
-                '--format=mkbootimg',
-            ]
+        kernel = self._get_test_file('kernel', 0x1000)
+        ramdisk = self._get_test_file('ramdisk', 0x1000)
 
-            subprocess.run(mkbootimg_cmds, check=True)
-            result = subprocess.run(unpack_bootimg_cmds, check=True,
-                                    capture_output=True, encoding='utf-8')
-            mkbootimg_cmds = [
-                'mkbootimg',
-                '--out', boot_img_reconstructed,
-            ]
-            mkbootimg_cmds.extend(shlex.split(result.stdout))
+        self._test_unpack_boot_image([
+            '--header_version', '4',
+            '--kernel', kernel,
+            '--ramdisk', ramdisk,
+            '--cmdline', TEST_KERNEL_CMDLINE,
+        ])
 
-            subprocess.run(mkbootimg_cmds, check=True)
-            self.assertTrue(
-                filecmp.cmp(boot_img, boot_img_reconstructed),
-                'reconstructed boot image differ from the original')
+    def test_unpack_boot_image_v3(self):
+        """Tests that mkbootimg(unpack_bootimg(image)) is an identity."""
+        kernel = self._get_test_file('kernel', 0x1000)
+        ramdisk = self._get_test_file('ramdisk', 0x1000)
+
+        self._test_unpack_boot_image([
+            '--header_version', '3',
+            '--kernel', kernel,
+            '--ramdisk', ramdisk,
+            '--cmdline', TEST_KERNEL_CMDLINE,
+            '--os_version', '11.0.0',
+            '--os_patch_level', '2021-01',
+        ])
 
     def test_unpack_boot_image_v2(self):
         """Tests that mkbootimg(unpack_bootimg(image)) is an identity."""
-        with tempfile.TemporaryDirectory() as temp_out_dir:
-            # Output image path.
-            boot_img = os.path.join(temp_out_dir, 'boot.img')
-            boot_img_reconstructed = os.path.join(
-                temp_out_dir, 'boot.img.reconstructed')
-            # Creates blank images first.
-            kernel = generate_test_file(
-                os.path.join(temp_out_dir, 'kernel'), 0x1000)
-            ramdisk = generate_test_file(
-                os.path.join(temp_out_dir, 'ramdisk'), 0x1000)
-            second = generate_test_file(
-                os.path.join(temp_out_dir, 'second'), 0x1000)
-            recovery_dtbo = generate_test_file(
-                os.path.join(temp_out_dir, 'recovery_dtbo'), 0x1000)
-            dtb = generate_test_file(
-                os.path.join(temp_out_dir, 'dtb'), 0x1000)
-
-            cmdline = (BOOT_ARGS_SIZE - 1) * 'x'
-            extra_cmdline = (BOOT_EXTRA_ARGS_SIZE - 1) * 'y'
-
-            mkbootimg_cmds = [
-                'mkbootimg',
-                '--header_version', '2',
-                '--base', '0x00000000',
-                '--kernel', kernel,
-                '--kernel_offset', '0x00008000',
-                '--ramdisk', ramdisk,
-                '--ramdisk_offset', '0x01000000',
-                '--second', second,
-                '--second_offset', '0x40000000',
-                '--recovery_dtbo', recovery_dtbo,
-                '--dtb', dtb,
-                '--dtb_offset', '0x01f00000',
-                '--tags_offset', '0x00000100',
-                '--pagesize', '0x00001000',
-                '--os_version', '11.0.0',
-                '--os_patch_level', '2021-03',
-                '--board', 'boot_v2',
-                '--cmdline', cmdline + extra_cmdline,
-                '--output', boot_img,
-            ]
-            unpack_bootimg_cmds = [
-                'unpack_bootimg',
-                '--boot_img', boot_img,
-                '--out', os.path.join(temp_out_dir, 'out'),
-                '--format=mkbootimg',
-            ]
-
-            subprocess.run(mkbootimg_cmds, check=True)
-            result = subprocess.run(unpack_bootimg_cmds, check=True,
-                                    capture_output=True, encoding='utf-8')
-            mkbootimg_cmds = [
-                'mkbootimg',
-                '--out', boot_img_reconstructed,
-            ]
-            mkbootimg_cmds.extend(shlex.split(result.stdout))
-
-            subprocess.run(mkbootimg_cmds, check=True)
-            self.assertTrue(
-                filecmp.cmp(boot_img, boot_img_reconstructed),
-                'reconstructed boot image differ from the original')
+        # Creates blank images first.
+        kernel = self._get_test_file('kernel', 0x1000)
+        ramdisk = self._get_test_file('ramdisk', 0x1000)
+        second = self._get_test_file('second', 0x1000)
+        recovery_dtbo = self._get_test_file('recovery_dtbo', 0x1000)
+        dtb = self._get_test_file('dtb', 0x1000)
+
+        cmdline = (BOOT_ARGS_SIZE - 1) * 'x'
+        extra_cmdline = (BOOT_EXTRA_ARGS_SIZE - 1) * 'y'
+
+        self._test_unpack_boot_image([
+            '--header_version', '2',
+            '--base', '0x00000000',
+            '--kernel', kernel,
+            '--kernel_offset', '0x00008000',
+            '--ramdisk', ramdisk,
+            '--ramdisk_offset', '0x01000000',
+            '--second', second,
+            '--second_offset', '0x40000000',
+            '--recovery_dtbo', recovery_dtbo,
+            '--dtb', dtb,
+            '--dtb_offset', '0x01f00000',
+            '--tags_offset', '0x00000100',
+            '--pagesize', '0x00001000',
+            '--os_version', '11.0.0',
+            '--os_patch_level', '2021-03',
+            '--board', 'boot_v2',
+            '--cmdline', cmdline + extra_cmdline,
+        ])
 
     def test_unpack_boot_image_v1(self):
         """Tests that mkbootimg(unpack_bootimg(image)) is an identity."""
-        with tempfile.TemporaryDirectory() as temp_out_dir:
-            # Output image path.
-            boot_img = os.path.join(temp_out_dir, 'boot.img')
-            boot_img_reconstructed = os.path.join(
-                temp_out_dir, 'boot.img.reconstructed')
-            # Creates blank images first.
-            kernel = generate_test_file(
-                os.path.join(temp_out_dir, 'kernel'), 0x1000)
-            ramdisk = generate_test_file(
-                os.path.join(temp_out_dir, 'ramdisk'), 0x1000)
-            recovery_dtbo = generate_test_file(
-                os.path.join(temp_out_dir, 'recovery_dtbo'), 0x1000)
-
-            cmdline = (BOOT_ARGS_SIZE - 1) * 'x'
-            extra_cmdline = (BOOT_EXTRA_ARGS_SIZE - 1) * 'y'
-
-            mkbootimg_cmds = [
-                'mkbootimg',
-                '--header_version', '1',
-                '--base', '0x00000000',
-                '--kernel', kernel,
-                '--kernel_offset', '0x00008000',
-                '--ramdisk', ramdisk,
-                '--ramdisk_offset', '0x01000000',
-                '--recovery_dtbo', recovery_dtbo,
-                '--tags_offset', '0x00000100',
-                '--pagesize', '0x00001000',
-                '--os_version', '11.0.0',
-                '--os_patch_level', '2021-03',
-                '--board', 'boot_v1',
-                '--cmdline', cmdline + extra_cmdline,
-                '--output', boot_img,
-            ]
-            unpack_bootimg_cmds = [
-                'unpack_bootimg',
-                '--boot_img', boot_img,
-                '--out', os.path.join(temp_out_dir, 'out'),
-                '--format=mkbootimg',
-            ]
-
-            subprocess.run(mkbootimg_cmds, check=True)
-            result = subprocess.run(unpack_bootimg_cmds, check=True,
-                                    capture_output=True, encoding='utf-8')
-            mkbootimg_cmds = [
-                'mkbootimg',
-                '--out', boot_img_reconstructed,
-            ]
-            mkbootimg_cmds.extend(shlex.split(result.stdout))
-
-            subprocess.run(mkbootimg_cmds, check=True)
-            self.assertTrue(
-                filecmp.cmp(boot_img, boot_img_reconstructed),
-                'reconstructed boot image differ from the original')
+        # Creates blank images first.
+        kernel = self._get_test_file('kernel', 0x1000)
+        ramdisk = self._get_test_file('ramdisk', 0x1000)
+        recovery_dtbo = self._get_test_file('recovery_dtbo', 0x1000)
+
+        cmdline = (BOOT_ARGS_SIZE - 1) * 'x'
+        extra_cmdline = (BOOT_EXTRA_ARGS_SIZE - 1) * 'y'
+
+        self._test_unpack_boot_image([
+            '--header_version', '1',
+            '--base', '0x00000000',
+            '--kernel', kernel,
+            '--kernel_offset', '0x00008000',
+            '--ramdisk', ramdisk,
+            '--ramdisk_offset', '0x01000000',
+            '--recovery_dtbo', recovery_dtbo,
+            '--tags_offset', '0x00000100',
+            '--pagesize', '0x00001000',
+            '--os_version', '11.0.0',
+            '--os_patch_level', '2021-03',
+            '--board', 'boot_v1',
+            '--cmdline', cmdline + extra_cmdline,
+        ])
 
     def test_unpack_boot_image_v0(self):
         """Tests that mkbootimg(unpack_bootimg(image)) is an identity."""
-        with tempfile.TemporaryDirectory() as temp_out_dir:
-            # Output image path.
-            boot_img = os.path.join(temp_out_dir, 'boot.img')
-            boot_img_reconstructed = os.path.join(
-                temp_out_dir, 'boot.img.reconstructed')
-            # Creates blank images first.
-            kernel = generate_test_file(
-                os.path.join(temp_out_dir, 'kernel'), 0x1000)
-            ramdisk = generate_test_file(
-                os.path.join(temp_out_dir, 'ramdisk'), 0x1000)
-            second = generate_test_file(
-                os.path.join(temp_out_dir, 'second'), 0x1000)
-
-            cmdline = (BOOT_ARGS_SIZE - 1) * 'x'
-            extra_cmdline = (BOOT_EXTRA_ARGS_SIZE - 1) * 'y'
-
-            mkbootimg_cmds = [
-                'mkbootimg',
-                '--header_version', '0',
-                '--base', '0x00000000',
-                '--kernel', kernel,
-                '--kernel_offset', '0x00008000',
-                '--ramdisk', ramdisk,
-                '--ramdisk_offset', '0x01000000',
-                '--second', second,
-                '--second_offset', '0x40000000',
-                '--tags_offset', '0x00000100',
-                '--pagesize', '0x00001000',
-                '--os_version', '11.0.0',
-                '--os_patch_level', '2021-03',
-                '--board', 'boot_v0',
-                '--cmdline', cmdline + extra_cmdline,
-                '--output', boot_img,
-            ]
-            unpack_bootimg_cmds = [
-                'unpack_bootimg',
-                '--boot_img', boot_img,
-                '--out', os.path.join(temp_out_dir, 'out'),
-            ]
-            unpack_bootimg_cmds = [
-                'unpack_bootimg',
-                '--boot_img', boot_img,
-                '--out', os.path.join(temp_out_dir, 'out'),
-                '--format=mkbootimg',
-            ]
-
-            subprocess.run(mkbootimg_cmds, check=True)
-            result = subprocess.run(unpack_bootimg_cmds, check=True,
-                                    capture_output=True, encoding='utf-8')
-            mkbootimg_cmds = [
-                'mkbootimg',
-                '--out', boot_img_reconstructed,
-            ]
-            mkbootimg_cmds.extend(shlex.split(result.stdout))
-
-            subprocess.run(mkbootimg_cmds, check=True)
-            self.assertTrue(
-                filecmp.cmp(boot_img, boot_img_reconstructed),
-                'reconstructed boot image differ from the original')
+        # Creates blank images first.
+        kernel = self._get_test_file('kernel', 0x1000)
+        ramdisk = self._get_test_file('ramdisk', 0x1000)
+        second = self._get_test_file('second', 0x1000)
+
+        cmdline = (BOOT_ARGS_SIZE - 1) * 'x'
+        extra_cmdline = (BOOT_EXTRA_ARGS_SIZE - 1) * 'y'
+
+        self._test_unpack_boot_image([
+            '--header_version', '0',
+            '--base', '0x00000000',
+            '--kernel', kernel,
+            '--kernel_offset', '0x00008000',
+            '--ramdisk', ramdisk,
+            '--ramdisk_offset', '0x01000000',
+            '--second', second,
+            '--second_offset', '0x40000000',
+            '--tags_offset', '0x00000100',
+            '--pagesize', '0x00001000',
+            '--os_version', '11.0.0',
+            '--os_patch_level', '2021-03',
+            '--board', 'boot_v0',
+            '--cmdline', cmdline + extra_cmdline,
+        ])
 
     def test_boot_image_v2_cmdline_null_terminator(self):
         """Tests that kernel commandline is null-terminated."""
         with tempfile.TemporaryDirectory() as temp_out_dir:
-            dtb = generate_test_file(os.path.join(temp_out_dir, 'dtb'), 0x1000)
-            kernel = generate_test_file(os.path.join(temp_out_dir, 'kernel'),
-                                        0x1000)
-            ramdisk = generate_test_file(os.path.join(temp_out_dir, 'ramdisk'),
-                                         0x1000)
+            dtb = self._get_test_file('dtb', 0x1000)
+            kernel = self._get_test_file('kernel', 0x1000)
+            ramdisk = self._get_test_file('ramdisk', 0x1000)
             cmdline = (BOOT_ARGS_SIZE - 1) * 'x'
             extra_cmdline = (BOOT_EXTRA_ARGS_SIZE - 1) * 'y'
             boot_img = os.path.join(temp_out_dir, 'boot.img')
@@ -697,13 +704,13 @@ class MkbootimgTest(unittest.TestCase):
                 '--output', boot_img,
             ]
 
-            subprocess.run(mkbootimg_cmds, check=True)
+            subprocess.run(mkbootimg_cmds, check=True,
+                           stdout=subprocess.DEVNULL)
 
-            with open(boot_img, 'rb') as f:
-                raw_boot_img = f.read()
-            raw_cmdline = raw_boot_img[BOOT_ARGS_OFFSET:][:BOOT_ARGS_SIZE]
-            raw_extra_cmdline = (raw_boot_img[BOOT_EXTRA_ARGS_OFFSET:]
-                                 [:BOOT_EXTRA_ARGS_SIZE])
+            raw_cmdline = read_file_range(boot_img, BOOT_ARGS_OFFSET,
+                                          BOOT_ARGS_SIZE)
+            raw_extra_cmdline = read_file_range(
+                boot_img, BOOT_EXTRA_ARGS_OFFSET, BOOT_EXTRA_ARGS_SIZE)
             self.assertEqual(raw_cmdline, cmdline.encode() + b'\x00')
             self.assertEqual(raw_extra_cmdline,
                              extra_cmdline.encode() + b'\x00')
@@ -711,10 +718,8 @@ class MkbootimgTest(unittest.TestCase):
     def test_boot_image_v3_cmdline_null_terminator(self):
         """Tests that kernel commandline is null-terminated."""
         with tempfile.TemporaryDirectory() as temp_out_dir:
-            kernel = generate_test_file(os.path.join(temp_out_dir, 'kernel'),
-                                        0x1000)
-            ramdisk = generate_test_file(os.path.join(temp_out_dir, 'ramdisk'),
-                                         0x1000)
+            kernel = self._get_test_file('kernel', 0x1000)
+            ramdisk = self._get_test_file('ramdisk', 0x1000)
             cmdline = BOOT_ARGS_SIZE * 'x' + (BOOT_EXTRA_ARGS_SIZE - 1) * 'y'
             boot_img = os.path.join(temp_out_dir, 'boot.img')
             mkbootimg_cmds = [
@@ -726,20 +731,19 @@ class MkbootimgTest(unittest.TestCase):
                 '--output', boot_img,
             ]
 
-            subprocess.run(mkbootimg_cmds, check=True)
+            subprocess.run(mkbootimg_cmds, check=True,
+                           stdout=subprocess.DEVNULL)
 
-            with open(boot_img, 'rb') as f:
-                raw_boot_img = f.read()
-            raw_cmdline = (raw_boot_img[BOOT_V3_ARGS_OFFSET:]
-                           [:BOOT_ARGS_SIZE + BOOT_EXTRA_ARGS_SIZE])
+            raw_cmdline = read_file_range(
+                boot_img, BOOT_V3_ARGS_OFFSET,
+                BOOT_ARGS_SIZE + BOOT_EXTRA_ARGS_SIZE)
             self.assertEqual(raw_cmdline, cmdline.encode() + b'\x00')
 
     def test_vendor_boot_image_v3_cmdline_null_terminator(self):
         """Tests that kernel commandline is null-terminated."""
         with tempfile.TemporaryDirectory() as temp_out_dir:
-            dtb = generate_test_file(os.path.join(temp_out_dir, 'dtb'), 0x1000)
-            ramdisk = generate_test_file(os.path.join(temp_out_dir, 'ramdisk'),
-                                         0x1000)
+            dtb = self._get_test_file('dtb', 0x1000)
+            ramdisk = self._get_test_file('ramdisk', 0x1000)
             vendor_cmdline = (VENDOR_BOOT_ARGS_SIZE - 1) * 'x'
             vendor_boot_img = os.path.join(temp_out_dir, 'vendor_boot.img')
             mkbootimg_cmds = [
@@ -751,12 +755,12 @@ class MkbootimgTest(unittest.TestCase):
                 '--vendor_boot', vendor_boot_img,
             ]
 
-            subprocess.run(mkbootimg_cmds, check=True)
+            subprocess.run(mkbootimg_cmds, check=True,
+                           stdout=subprocess.DEVNULL)
 
-            with open(vendor_boot_img, 'rb') as f:
-                raw_vendor_boot_img = f.read()
-            raw_vendor_cmdline = (raw_vendor_boot_img[VENDOR_BOOT_ARGS_OFFSET:]
-                                  [:VENDOR_BOOT_ARGS_SIZE])
+            raw_vendor_cmdline = read_file_range(
+                vendor_boot_img, VENDOR_BOOT_ARGS_OFFSET,
+                VENDOR_BOOT_ARGS_SIZE)
             self.assertEqual(raw_vendor_cmdline,
                              vendor_cmdline.encode() + b'\x00')
 
@@ -764,8 +768,7 @@ class MkbootimgTest(unittest.TestCase):
         """Tests building vendor_boot version 4 without dtb image."""
         with tempfile.TemporaryDirectory() as temp_out_dir:
             vendor_boot_img = os.path.join(temp_out_dir, 'vendor_boot.img')
-            ramdisk = generate_test_file(
-                os.path.join(temp_out_dir, 'ramdisk'), 0x1000)
+            ramdisk = self._get_test_file('ramdisk', 0x1000)
             mkbootimg_cmds = [
                 'mkbootimg',
                 '--header_version', '4',
@@ -783,7 +786,8 @@ class MkbootimgTest(unittest.TestCase):
                 'dtb size: 0',
             ]
 
-            subprocess.run(mkbootimg_cmds, check=True)
+            subprocess.run(mkbootimg_cmds, check=True,
+                           stdout=subprocess.DEVNULL)
             result = subprocess.run(unpack_bootimg_cmds, check=True,
                                     capture_output=True, encoding='utf-8')
             output = [line.strip() for line in result.stdout.splitlines()]
@@ -804,8 +808,7 @@ class MkbootimgTest(unittest.TestCase):
             vendor_boot_img = os.path.join(temp_out_dir, 'vendor_boot.img')
             vendor_boot_img_reconstructed = os.path.join(
                 temp_out_dir, 'vendor_boot.img.reconstructed')
-            ramdisk = generate_test_file(
-                os.path.join(temp_out_dir, 'ramdisk'), 0x121212)
+            ramdisk = self._get_test_file('ramdisk', 0x121212)
 
             mkbootimg_cmds = [
                 'mkbootimg',
@@ -819,7 +822,8 @@ class MkbootimgTest(unittest.TestCase):
                 '--out', os.path.join(temp_out_dir, 'out'),
                 '--format=mkbootimg',
             ]
-            subprocess.run(mkbootimg_cmds, check=True)
+            subprocess.run(mkbootimg_cmds, check=True,
+                           stdout=subprocess.DEVNULL)
             result = subprocess.run(unpack_bootimg_cmds, check=True,
                                     capture_output=True, encoding='utf-8')
             mkbootimg_cmds = [
@@ -829,7 +833,8 @@ class MkbootimgTest(unittest.TestCase):
             unpack_format_args = shlex.split(result.stdout)
             mkbootimg_cmds.extend(unpack_format_args)
 
-            subprocess.run(mkbootimg_cmds, check=True)
+            subprocess.run(mkbootimg_cmds, check=True,
+                           stdout=subprocess.DEVNULL)
             self.assertTrue(
                 filecmp.cmp(vendor_boot_img, vendor_boot_img_reconstructed),
                 'reconstructed vendor_boot image differ from the original')
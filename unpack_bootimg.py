@@ -20,7 +20,7 @@ Extracts the kernel, ramdisk, second bootloader, dtb and recovery dtbo images.
 """
 
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
-from struct import unpack
+from struct import Struct, unpack
 import os
 import shlex
 
@@ -28,6 +28,21 @@ BOOT_IMAGE_HEADER_V3_PAGESIZE = 4096
 VENDOR_RAMDISK_NAME_SIZE = 32
 VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE = 16
 
+# The boot image headers, so that each one is parsed with a single call.
+# header_version is at the same offset in all boot image header versions.
+BOOT_IMAGE_HEADER_VERSION_STRUCT = Struct('<40xI')
+BOOT_IMAGE_HEADER_V0_STRUCT = Struct('<8s10I16s512s32s1024s')
+BOOT_IMAGE_HEADER_V1_STRUCT = Struct('<8s10I16s512s32s1024sIQI')
+BOOT_IMAGE_HEADER_V2_STRUCT = Struct('<8s10I16s512s32s1024sIQIIQ')
+BOOT_IMAGE_HEADER_V3_STRUCT = Struct('<8s9I1536s')
+BOOT_IMAGE_HEADER_V4_STRUCT = Struct('<8s9I1536sI')
+VENDOR_BOOT_IMAGE_HEADER_VERSION_STRUCT = Struct('<8xI')
+VENDOR_BOOT_IMAGE_HEADER_V3_STRUCT = Struct('<8s5I2048sI16sIIQ')
+VENDOR_BOOT_IMAGE_HEADER_V4_STRUCT = Struct('<8s5I2048sI16sIIQ4I')
+VENDOR_RAMDISK_TABLE_ENTRY_STRUCT = Struct(
+    f'<3I{VENDOR_RAMDISK_NAME_SIZE}s'
+    f'{VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE}I')
+
 
 def create_out_dir(dir_path):
     """creates a directory 'dir_path' if it does not exist"""
@@ -37,9 +52,21 @@ def create_out_dir(dir_path):
 
 def extract_image(offset, size, bootimage, extracted_image_name):
     """extracts an image from the bootimage"""
-    bootimage.seek(offset)
     with open(extracted_image_name, 'wb') as file_out:
-        file_out.write(bootimage.read(size))
+        try:
+            # Lets the kernel copy the data with sendfile(), so the image
+            # isn't read into memory first.
+            while size > 0:
+                sent = os.sendfile(file_out.fileno(), bootimage.fileno(),
+                                   offset, size)
+                if sent == 0:
+                    break
+                offset += sent
+                size -= sent
+        except (AttributeError, OSError):
+            # sendfile() is unavailable or unsupported for these files.
+            bootimage.seek(offset)
+            file_out.write(bootimage.read(size))
 
 
 def get_number_of_pages(image_size, page_size):
@@ -48,8 +75,8 @@ def get_number_of_pages(image_size, page_size):
 
 
 def cstr(s):
-    """Remove first NULL character and any character beyond."""
-    return s.split('\0', 1)[0]
+    """Remove first NULL byte and any byte beyond, then decode the rest."""
+    return s.split(b'\0', 1)[0].decode()
 
 
 def format_os_version(os_version):
@@ -184,104 +211,84 @@ class BootImageInfoFormatter:
 def unpack_boot_image(boot_img, output_dir):
     """extracts kernel, ramdisk, second bootloader and recovery dtbo"""
     info = BootImageInfoFormatter()
-    info.boot_magic = unpack('8s', boot_img.read(8))[0].decode()
-
-    kernel_ramdisk_second_info = unpack('9I', boot_img.read(9 * 4))
-    # header_version is always at [8] regardless of the value of header_version.
-    info.header_version = kernel_ramdisk_second_info[8]
+    # Reads the whole header at once, the largest header is the v2 one.
+    header = boot_img.read(BOOT_IMAGE_HEADER_V2_STRUCT.size)
+    info.header_version = BOOT_IMAGE_HEADER_VERSION_STRUCT.unpack_from(
+        header)[0]
 
     if info.header_version < 3:
-        info.kernel_size = kernel_ramdisk_second_info[0]
-        info.kernel_load_address = kernel_ramdisk_second_info[1]
-        info.ramdisk_size = kernel_ramdisk_second_info[2]
-        info.ramdisk_load_address = kernel_ramdisk_second_info[3]
-        info.second_size = kernel_ramdisk_second_info[4]
-        info.second_load_address = kernel_ramdisk_second_info[5]
-        info.tags_load_address = kernel_ramdisk_second_info[6]
-        info.page_size = kernel_ramdisk_second_info[7]
-        os_version_patch_level = unpack('I', boot_img.read(1 * 4))[0]
+        header_struct = (BOOT_IMAGE_HEADER_V0_STRUCT,
+                         BOOT_IMAGE_HEADER_V1_STRUCT,
+                         BOOT_IMAGE_HEADER_V2_STRUCT)[info.header_version]
+        (boot_magic, info.kernel_size, info.kernel_load_address,
+         info.ramdisk_size, info.ramdisk_load_address, info.second_size,
+         info.second_load_address, info.tags_load_address, info.page_size,
+         _, os_version_patch_level, product_name, cmdline, _sha,
+         extra_cmdline, *v1_v2_fields) = header_struct.unpack_from(header)
+        info.product_name = cstr(product_name)
+        info.extra_cmdline = cstr(extra_cmdline)
     else:
-        info.kernel_size = kernel_ramdisk_second_info[0]
-        info.ramdisk_size = kernel_ramdisk_second_info[1]
-        os_version_patch_level = kernel_ramdisk_second_info[2]
+        header_struct = (BOOT_IMAGE_HEADER_V3_STRUCT
+                         if info.header_version == 3
+                         else BOOT_IMAGE_HEADER_V4_STRUCT)
+        (boot_magic, info.kernel_size, info.ramdisk_size,
+         os_version_patch_level, _, _, _, _, _, _, cmdline,
+         *v4_fields) = header_struct.unpack_from(header)
         info.second_size = 0
         info.page_size = BOOT_IMAGE_HEADER_V3_PAGESIZE
 
+    info.boot_magic = boot_magic.decode()
     info.os_version, info.os_patch_level = decode_os_version_patch_level(
         os_version_patch_level)
-
-    if info.header_version < 3:
-        info.product_name = cstr(unpack('16s',
-                                        boot_img.read(16))[0].decode())
-        info.cmdline = cstr(unpack('512s', boot_img.read(512))[0].decode())
-        boot_img.read(32)  # ignore SHA
-        info.extra_cmdline = cstr(unpack('1024s',
-                                         boot_img.read(1024))[0].decode())
-    else:
-        info.cmdline = cstr(unpack('1536s',
-                                   boot_img.read(1536))[0].decode())
+    info.cmdline = cstr(cmdline)
 
     if info.header_version in {1, 2}:
-        info.recovery_dtbo_size = unpack('I', boot_img.read(1 * 4))[0]
-        info.recovery_dtbo_offset = unpack('Q', boot_img.read(8))[0]
-        info.boot_header_size = unpack('I', boot_img.read(4))[0]
+        (info.recovery_dtbo_size, info.recovery_dtbo_offset,
+         info.boot_header_size) = v1_v2_fields[:3]
     else:
         info.recovery_dtbo_size = 0
 
     if info.header_version == 2:
-        info.dtb_size = unpack('I', boot_img.read(4))[0]
-        info.dtb_load_address = unpack('Q', boot_img.read(8))[0]
+        info.dtb_size, info.dtb_load_address = v1_v2_fields[3:]
     else:
         info.dtb_size = 0
         info.dtb_load_address = 0
 
     if info.header_version >= 4:
-        info.boot_signature_size = unpack('I', boot_img.read(4))[0]
+        info.boot_signature_size = v4_fields[0]
     else:
         info.boot_signature_size = 0
 
-    # The first page contains the boot header
-    num_header_pages = 1
-
     # Convenient shorthand.
     page_size = info.page_size
 
-    num_kernel_pages = get_number_of_pages(info.kernel_size, page_size)
-    kernel_offset = page_size * num_header_pages  # header occupies a page
-    image_info_list = [(kernel_offset, info.kernel_size, 'kernel')]
+    # The first page contains the boot header, then each image starts at the
+    # page following the previous one.
+    offset = page_size
+    image_info_list = [(offset, info.kernel_size, 'kernel')]
+    offset += page_size * get_number_of_pages(info.kernel_size, page_size)
 
-    num_ramdisk_pages = get_number_of_pages(info.ramdisk_size, page_size)
-    ramdisk_offset = page_size * (num_header_pages + num_kernel_pages
-                                 ) # header + kernel
-    image_info_list.append((ramdisk_offset, info.ramdisk_size, 'ramdisk'))
+    image_info_list.append((offset, info.ramdisk_size, 'ramdisk'))
+    offset += page_size * get_number_of_pages(info.ramdisk_size, page_size)
 
     if info.second_size > 0:
-        second_offset = page_size * (
-            num_header_pages + num_kernel_pages + num_ramdisk_pages
-            )  # header + kernel + ramdisk
-        image_info_list.append((second_offset, info.second_size, 'second'))
+        image_info_list.append((offset, info.second_size, 'second'))
+        offset += page_size * get_number_of_pages(info.second_size, page_size)
 
     if info.recovery_dtbo_size > 0:
         image_info_list.append((info.recovery_dtbo_offset,
                                 info.recovery_dtbo_size,
                                 'recovery_dtbo'))
-    if info.dtb_size > 0:
-        num_second_pages = get_number_of_pages(info.second_size, page_size)
-        num_recovery_dtbo_pages = get_number_of_pages(
+        offset += page_size * get_number_of_pages(
             info.recovery_dtbo_size, page_size)
-        dtb_offset = page_size * (
-            num_header_pages + num_kernel_pages + num_ramdisk_pages +
-            num_second_pages + num_recovery_dtbo_pages)
 
-        image_info_list.append((dtb_offset, info.dtb_size, 'dtb'))
+    if info.dtb_size > 0:
+        image_info_list.append((offset, info.dtb_size, 'dtb'))
 
     if info.boot_signature_size > 0:
         # boot signature only exists in boot.img version >= v4.
         # There are only kernel and ramdisk pages before the signature.
-        boot_signature_offset = page_size * (
-            num_header_pages + num_kernel_pages + num_ramdisk_pages)
-
-        image_info_list.append((boot_signature_offset, info.boot_signature_size,
+        image_info_list.append((offset, info.boot_signature_size,
                                 'boot_signature'))
 
     create_out_dir(output_dir)
@@ -319,6 +326,9 @@ class VendorBootImageInfoFormatter:
                 f'vendor ramdisk table size: {self.vendor_ramdisk_table_size}')
             lines.append('vendor ramdisk table: [')
             indent = lambda level: ' ' * 4 * level
+            # Formats a whole row of board_id at once.
+            stride = 4
+            board_id_row_format = indent(3) + ' '.join(['%#010x,'] * stride)
             for entry in self.vendor_ramdisk_table:
                 (output_ramdisk_name, ramdisk_size, ramdisk_offset,
                  ramdisk_type, ramdisk_name, board_id) = entry
@@ -328,11 +338,9 @@ class VendorBootImageInfoFormatter:
                 lines.append(indent(2) + f'type: {ramdisk_type:#x}')
                 lines.append(indent(2) + f'name: {ramdisk_name}')
                 lines.append(indent(2) + 'board_id: [')
-                stride = 4
                 for row_idx in range(0, len(board_id), stride):
-                    row = board_id[row_idx:row_idx + stride]
-                    lines.append(
-                        indent(3) + ' '.join(f'{e:#010x},' for e in row))
+                    row = tuple(board_id[row_idx:row_idx + stride])
+                    lines.append(board_id_row_format % row)
                 lines.append(indent(2) + ']')
                 lines.append(indent(1) + '}')
             lines.append(']')
@@ -380,18 +388,20 @@ class VendorBootImageInfoFormatter:
 
 def unpack_vendor_boot_image(boot_img, output_dir):
     info = VendorBootImageInfoFormatter()
-    info.boot_magic = unpack('8s', boot_img.read(8))[0].decode()
-    info.header_version = unpack('I', boot_img.read(4))[0]
-    info.page_size = unpack('I', boot_img.read(4))[0]
-    info.kernel_load_address = unpack('I', boot_img.read(4))[0]
-    info.ramdisk_load_address = unpack('I', boot_img.read(4))[0]
-    info.vendor_ramdisk_size = unpack('I', boot_img.read(4))[0]
-    info.cmdline = cstr(unpack('2048s', boot_img.read(2048))[0].decode())
-    info.tags_load_address = unpack('I', boot_img.read(4))[0]
-    info.product_name = cstr(unpack('16s', boot_img.read(16))[0].decode())
-    info.header_size = unpack('I', boot_img.read(4))[0]
-    info.dtb_size = unpack('I', boot_img.read(4))[0]
-    info.dtb_load_address = unpack('Q', boot_img.read(8))[0]
+    # Reads the whole header at once, the largest header is the v4 one.
+    header = boot_img.read(VENDOR_BOOT_IMAGE_HEADER_V4_STRUCT.size)
+    info.header_version = VENDOR_BOOT_IMAGE_HEADER_VERSION_STRUCT.unpack_from(
+        header)[0]
+    header_struct = (VENDOR_BOOT_IMAGE_HEADER_V3_STRUCT
+                     if info.header_version < 4
+                     else VENDOR_BOOT_IMAGE_HEADER_V4_STRUCT)
+    (boot_magic, _, info.page_size, info.kernel_load_address,
+     info.ramdisk_load_address, info.vendor_ramdisk_size, cmdline,
+     info.tags_load_address, product_name, info.header_size, info.dtb_size,
+     info.dtb_load_address, *v4_fields) = header_struct.unpack_from(header)
+    info.boot_magic = boot_magic.decode()
+    info.cmdline = cstr(cmdline)
+    info.product_name = cstr(product_name)
 
     # Convenient shorthand.
     page_size = info.page_size
@@ -405,31 +415,30 @@ def unpack_vendor_boot_image(boot_img, output_dir):
     image_info_list = []
 
     if info.header_version > 3:
-        info.vendor_ramdisk_table_size = unpack('I', boot_img.read(4))[0]
-        vendor_ramdisk_table_entry_num = unpack('I', boot_img.read(4))[0]
-        vendor_ramdisk_table_entry_size = unpack('I', boot_img.read(4))[0]
-        info.vendor_bootconfig_size = unpack('I', boot_img.read(4))[0]
+        (info.vendor_ramdisk_table_size, vendor_ramdisk_table_entry_num,
+         vendor_ramdisk_table_entry_size,
+         info.vendor_bootconfig_size) = v4_fields
         num_vendor_ramdisk_table_pages = get_number_of_pages(
             info.vendor_ramdisk_table_size, page_size)
         vendor_ramdisk_table_offset = page_size * (
             num_boot_header_pages + num_boot_ramdisk_pages + num_boot_dtb_pages)
 
+        # Reads the whole table at once, then unpacks each entry from it.
+        # Entries are vendor_ramdisk_table_entry_size apart, which may be
+        # larger than the entry fields known here.
+        boot_img.seek(vendor_ramdisk_table_offset)
+        vendor_ramdisk_table_data = boot_img.read(
+            vendor_ramdisk_table_entry_size * vendor_ramdisk_table_entry_num)
+
         vendor_ramdisk_table = []
         vendor_ramdisk_symlinks = []
         for idx in range(vendor_ramdisk_table_entry_num):
-            entry_offset = vendor_ramdisk_table_offset + (
-                vendor_ramdisk_table_entry_size * idx)
-            boot_img.seek(entry_offset)
-            ramdisk_size = unpack('I', boot_img.read(4))[0]
-            ramdisk_offset = unpack('I', boot_img.read(4))[0]
-            ramdisk_type = unpack('I', boot_img.read(4))[0]
-            ramdisk_name = cstr(unpack(
-                f'{VENDOR_RAMDISK_NAME_SIZE}s',
-                boot_img.read(VENDOR_RAMDISK_NAME_SIZE))[0].decode())
-            board_id = unpack(
-                f'{VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE}I',
-                boot_img.read(
-                    4 * VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE))
+            (ramdisk_size, ramdisk_offset, ramdisk_type, ramdisk_name,
+             *board_id) = VENDOR_RAMDISK_TABLE_ENTRY_STRUCT.unpack_from(
+                 vendor_ramdisk_table_data,
+                 vendor_ramdisk_table_entry_size * idx)
+            ramdisk_name = cstr(ramdisk_name)
+            board_id = tuple(board_id)
             output_ramdisk_name = f'vendor_ramdisk{idx:02}'
 
             image_info_list.append((ramdisk_offset_base + ramdisk_offset,